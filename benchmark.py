@@ -0,0 +1,387 @@
+""" measure request latency and Redis commands of the werbinich handlers
+
+Drives the WSGI app in-process with `werkzeug.test.Client` against a
+local Redis stand-in (fakeredis, or a spawned `redis-server`), seeded
+with N users and M games. Prints one JSON document with p50/p99 latency
+and Redis command counts per operation, e.g.
+
+    python benchmark.py --users 100 1000 10000 --games 50 --output bench.json
+
+With `--stress N`, N clients instead create, join and leave games and set
+characters at the same time; the report lists every inconsistency found
+between players, games and the lobby afterwards.
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import redis
+import redis.client
+
+from passlib.hash import pbkdf2_sha256 as sha256
+from werkzeug.test import Client
+
+import werbinich
+
+OPERATIONS = ["login", "join_game", "reload_game", "toggle_solved", "leave_game"]
+PLAYERS_PER_GAME = 6
+PASSWORD = "benchmark-pw"
+
+
+class CommandCounter(object):
+    """ count the Redis commands and round trips sent through redis-py """
+
+    def __init__(self):
+        self.commands = 0
+        self.round_trips = 0
+
+    def reset(self):
+        counts = self.commands, self.round_trips
+        self.commands = 0
+        self.round_trips = 0
+        return counts
+
+    def install(self):
+        counter = self
+        execute_command = redis.Redis.execute_command
+        execute_pipeline = redis.client.Pipeline.execute
+        immediate_execute_command = redis.client.Pipeline.immediate_execute_command
+
+        def counting_execute_command(client, *args, **options):
+            counter.commands += 1
+            counter.round_trips += 1
+            return execute_command(client, *args, **options)
+
+        def counting_execute_pipeline(pipe, *args, **kwargs):
+            if pipe.command_stack:
+                counter.commands += len(pipe.command_stack)
+                counter.round_trips += 1
+            return execute_pipeline(pipe, *args, **kwargs)
+
+        def counting_immediate_execute_command(pipe, *args, **options):
+            counter.commands += 1
+            counter.round_trips += 1
+            return immediate_execute_command(pipe, *args, **options)
+
+        redis.Redis.execute_command = counting_execute_command
+        redis.client.Pipeline.execute = counting_execute_pipeline
+        redis.client.Pipeline.immediate_execute_command = counting_immediate_execute_command
+
+
+def add_lua_cjson():
+    """
+    give the Lua scripts run by fakeredis (through `lupa`) the `cjson` module
+    that real Redis servers provide
+    """
+    import lupa
+    runtime_class = lupa.LuaRuntime
+
+    def to_python(value):
+        if lupa.lua_type(value) == "table":
+            items = sorted(value.items(), key=lambda item: str(item[0]))
+            if all(isinstance(key, int) for key, _ in items) and items:
+                return [to_python(item) for _, item in sorted(items)]
+            return {to_python(key): to_python(item) for key, item in items}
+        if isinstance(value, bytes):
+            return value.decode()
+        return value
+
+    def create_runtime(*args, **kwargs):
+        runtime = runtime_class(*args, **kwargs)
+        runtime.eval("function(encode) cjson = {encode = encode} end")(
+            lambda value: json.dumps(to_python(value)).encode()
+        )
+        return runtime
+
+    lupa.LuaRuntime = create_runtime
+
+
+def use_fakeredis():
+    """ point all connection pools of the app at one in-process fake server """
+    import fakeredis
+    server = fakeredis.FakeServer()
+    add_lua_cjson()
+
+    def create_connection_pool(config, max_connections=None, client_module=redis,
+                               decode_responses=True, replica=False):
+        return redis.ConnectionPool(
+            connection_class=fakeredis.FakeConnection,
+            server=server,
+            decode_responses=decode_responses
+        )
+
+    werbinich.create_connection_pool = create_connection_pool
+
+
+def start_redis_server(executable):
+    """ spawn a throwaway redis-server on a free port, return the process and port """
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    process = subprocess.Popen(
+        [executable, "--port", str(port), "--save", "", "--appendonly", "no"],
+        stdout=subprocess.DEVNULL
+    )
+    client = redis.StrictRedis(port=port)
+    for _ in range(50):
+        try:
+            client.ping()
+            break
+        except redis.ConnectionError:
+            time.sleep(0.1)
+    return process, port
+
+
+def seed(app, users, games, pw_hash):
+    """ create `users` users, the first `games` * 6 of them playing in `games` games """
+    app.redis.flushdb()
+    pipe = app.redis.pipeline(transaction=False)
+    pipe.set(werbinich.SCHEMA_VERSION_KEY, werbinich.SCHEMA_VERSION)
+    for i in range(users):
+        username = f"user{i}"
+        game_id = f"game{i // PLAYERS_PER_GAME}" if i < games * PLAYERS_PER_GAME else None
+        pipe.hset(app.user_key(username), mapping={"name": f"User {i}", "pw_hash": pw_hash})
+        if game_id is not None:
+            pipe.hset(app.player_key(username), "game_id", game_id)
+            pipe.sadd(werbinich.GAMES_KEY, game_id)
+            pipe.sadd(app.game_players_key(game_id), username)
+            if i % PLAYERS_PER_GAME == 0:
+                pipe.hset(app.game_key(game_id), mapping={"host": username, "pw_hash": pw_hash})
+        if len(pipe) > 1000:
+            pipe.execute()
+    pipe.execute()
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def run(app, counter, users, games, samples):
+    """ run `samples` rounds of the operations with idle users, collect timings """
+    timings = {operation: [] for operation in OPERATIONS}
+    commands = {operation: [] for operation in OPERATIONS}
+    idle_users = range(games * PLAYERS_PER_GAME, users)
+    for i in range(samples):
+        username = f"user{idle_users[i % len(idle_users)]}"
+        game_id = f"game{i % games}"
+        other_player = f"user{(i % games) * PLAYERS_PER_GAME}"
+        client = Client(app)
+        forms = {
+            "login": {"username": username, "login_pw": PASSWORD},
+            "join_game": {"game_id": game_id, "game_pw": PASSWORD},
+            "reload_game": {},
+            "toggle_solved": {"user_id": other_player},
+            "leave_game": {},
+        }
+        for operation in OPERATIONS:
+            counter.reset()
+            start = time.perf_counter()
+            response = client.post("/", data=dict(forms[operation], operation=operation))
+            elapsed = time.perf_counter() - start
+            if response.status_code != 200:
+                raise RuntimeError(f"{operation} failed with {response.status}")
+            timings[operation].append(elapsed * 1000)
+            commands[operation].append(counter.reset())
+    report = {}
+    for operation in OPERATIONS:
+        report[operation] = {
+            "p50_ms": round(percentile(timings[operation], 0.5), 3),
+            "p99_ms": round(percentile(timings[operation], 0.99), 3),
+            "redis_commands": percentile([c for c, _ in commands[operation]], 0.5),
+            "redis_round_trips": percentile([r for _, r in commands[operation]], 0.5),
+        }
+    return report
+
+
+def post_concurrently(clients, forms, path="/", as_json=False):
+    """ post one form per client, all released at once, return the response texts """
+    barrier = threading.Barrier(len(clients))
+
+    def post(client, form):
+        barrier.wait()
+        if as_json:
+            return client.post(path, json=form).get_data(as_text=True)
+        return client.post(path, data=form).get_data(as_text=True)
+
+    with ThreadPoolExecutor(len(clients)) as pool:
+        return list(pool.map(post, clients, forms))
+
+
+def check_games(app):
+    """ list inconsistencies between player hashes, games and the lobby """
+    problems = []
+    game_ids = app.redis.smembers(werbinich.GAMES_KEY)
+    for game_id in sorted(game_ids):
+        players = app.redis.smembers(app.game_players_key(game_id))
+        host = app.redis.hget(app.game_key(game_id), "host")
+        if not players:
+            problems.append(f"{game_id}: game without players")
+        elif host not in players:
+            problems.append(f"{game_id}: host {host} does not play")
+        for player in sorted(players):
+            if app.get_game_id(player) != game_id:
+                problems.append(f"{game_id}: {player} plays elsewhere")
+    for key in app.redis.scan_iter(match=f"{werbinich.PLAYER_KEY_PREFIX}*"):
+        username = key[len(werbinich.PLAYER_KEY_PREFIX):]
+        game_id = app.get_game_id(username)
+        if not app.redis.sismember(app.game_players_key(game_id or ""), username):
+            problems.append(f"{username}: missing from game {game_id}")
+    if set(app.redis.zrange(werbinich.LOBBY_KEY, 0, -1)) != game_ids:
+        problems.append("lobby does not list exactly the games")
+    return problems
+
+
+def stress(app, threads, games, rounds):
+    """
+    race `threads` clients creating one game, setting the same characters and
+    randomly joining and leaving `games` games for `rounds` rounds
+    """
+    clients = [Client(app) for _ in range(threads)]
+    for i, client in enumerate(clients):
+        client.post("/", data={"operation": "login", "username": f"user{i}", "login_pw": PASSWORD})
+    join = {"operation": "join_game", "game_id": "stress", "game_pw": PASSWORD}
+    pages = post_concurrently(clients, [join] * threads)
+    created = sum("Spiel erstellt!" in page for page in pages)
+    players = app.redis.smembers(app.game_players_key("stress"))
+    pages = post_concurrently(clients[1:], [
+        {"operation": "set_player_character", "player": "user0", "character": f"char{i}"}
+        for i in range(1, threads)
+    ])
+    winners = [f"char{i}" for i, page in enumerate(pages, 1) if "class=error" not in page]
+    character = app.redis.hget(app.player_key("user0"), "character")
+    problems = []
+    if created != 1:
+        problems.append(f"stress: created {created} times")
+    if len(players) != threads:
+        problems.append(f"stress: {len(players)} of {threads} players joined")
+    if winners != [character]:
+        problems.append(f"user0: characters {winners} set, {character} stored")
+    responses = post_concurrently(
+        clients[2:],
+        [{"character": f"char{i}"} for i in range(2, threads)],
+        path="/api/v1/games/stress/players/user1/character",
+        as_json=True
+    )
+    winners = [f"char{i}" for i, body in enumerate(responses, 2) if "error" not in body]
+    character = app.redis.hget(app.player_key("user1"), "character")
+    if winners != [character]:
+        problems.append(f"user1: characters {winners} set through the API, {character} stored")
+    randoms = [random.Random(i) for i in range(threads)]
+    for _ in range(rounds):
+        post_concurrently(clients, [
+            {"operation": "join_game", "game_id": f"stress{rng.randrange(games)}",
+             "game_pw": PASSWORD}
+            if rng.random() < 0.7 else {"operation": "leave_game"}
+            for rng in randoms
+        ])
+        problems.extend(check_games(app))
+    post_concurrently(clients, [{"operation": "leave_game"}] * threads)
+    problems.extend(check_games(app))
+    if app.redis.scard(werbinich.GAMES_KEY):
+        problems.append("games left after everybody left")
+    return {
+        "threads": threads,
+        "games": games,
+        "rounds": rounds,
+        "created": created,
+        "characters_set": len(winners),
+        "problems": problems,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, nargs="+", default=[100, 1000])
+    parser.add_argument("--games", type=int, default=10)
+    parser.add_argument("--samples", type=int, default=50)
+    parser.add_argument("--hash-rounds", type=int, default=29000)
+    parser.add_argument(
+        "--stress",
+        type=int,
+        metavar="THREADS",
+        help="race this many clients on a few games instead of measuring latency"
+    )
+    parser.add_argument("--rounds", type=int, default=20, help="rounds of --stress")
+    parser.add_argument(
+        "--redis-server",
+        nargs="?",
+        const=shutil.which("redis-server") or "redis-server",
+        help="spawn this redis-server instead of using fakeredis"
+    )
+    parser.add_argument("--output", help="write the JSON report to this file")
+    args = parser.parse_args()
+
+    process = None
+    app = None
+    config = {"hash_rounds": args.hash_rounds, "rate_limits": {}}
+    if args.stress:
+        config["hash_queue_size"] = args.stress
+    if args.redis_server:
+        process, config["redis_port"] = start_redis_server(args.redis_server)
+        config["redis_db"] = 0
+    else:
+        use_fakeredis()
+    try:
+        app = werbinich.create_app(with_static=False, config=config)
+        pw_hash = sha256.using(rounds=args.hash_rounds).hash(PASSWORD)
+        counter = CommandCounter()
+        counter.install()
+        results = []
+        if args.stress:
+            seed(app, args.stress, 0, pw_hash)
+            results.append(stress(app, args.stress, args.games, args.rounds))
+        for users in args.users if not args.stress else ():
+            if users <= args.games * PLAYERS_PER_GAME:
+                parser.error("--users must be larger than --games * 6")
+            seed(app, users, args.games, pw_hash)
+            results.append({
+                "users": users,
+                "games": args.games,
+                "operations": run(app, counter, users, args.games, args.samples),
+            })
+    finally:
+        if app is not None:
+            app.hashing.shutdown()
+        if process is not None:
+            process.terminate()
+    report = {
+        "revision": git_revision(),
+        "backend": "redis-server" if args.redis_server else "fakeredis",
+        "samples": args.samples,
+        "hash_rounds": args.hash_rounds,
+        "mode": "stress" if args.stress else "latency",
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    if any(result.get("problems") for result in results):
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
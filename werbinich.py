@@ -1,6 +1,29 @@
 """ a server to complement werbinichbot """
+import argparse
+import asyncio
+import collections
+import gzip
+import hashlib
+import io
+import itertools
+import json
+import logging
+import math
+import mimetypes
+import multiprocessing
 import os
+import sys
+import threading
+import time
 import redis
+import redis.asyncio
+import redis.asyncio.sentinel
+import redis.client
+import redis.sentinel
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta
 
 from components.py_input_validator.validator import (
     validate_username,
@@ -10,29 +33,994 @@ from components.py_input_validator.validator import (
 from werkzeug.urls import url_parse
 from werkzeug.wrappers import Request, Response
 from werkzeug.routing import Map, Rule
-from werkzeug.exceptions import HTTPException, NotFound
-from werkzeug.middleware.shared_data import SharedDataMiddleware
+from werkzeug.exceptions import (
+    BadRequest,
+    Conflict,
+    Forbidden,
+    HTTPException,
+    NotFound,
+    ServiceUnavailable,
+    TooManyRequests,
+    Unauthorized
+)
 from werkzeug.utils import redirect
-from secure_cookie.session import FilesystemSessionStore
-from jinja2 import Environment, FileSystemLoader
+from werkzeug.http import parse_cookie
+from werkzeug.middleware.proxy_fix import ProxyFix
+from secure_cookie.cookie import SecureCookie
+from secure_cookie.session import FilesystemSessionStore, Session, SessionStore
+from jinja2 import BytecodeCache, Environment, FileSystemBytecodeCache, FileSystemLoader
 from passlib.hash import pbkdf2_sha256 as sha256
 
-session_store = FilesystemSessionStore()
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
-class Werbinich(object):
+USER_KEY_PREFIX = "user:"
+SESSION_KEY_PREFIX = "session:"
+SESSION_TTL = 60 * 60 * 24 * 7
+GAMES_KEY = "games"
+GAME_KEY_PREFIX = "game:"
+PLAYER_KEY_PREFIX = "player:"
+SCHEMA_VERSION_KEY = "schema:version"
+SCHEMA_VERSION = 2
+LOBBY_KEY_PREFIX = "lobby:"
+LOBBY_KEY = "lobby:activity"
+LOBBY_IDS_KEY = "lobby:ids"
+RATE_LIMIT_KEY_PREFIX = "ratelimit:"
+CACHE_INVALIDATE_CHANNEL = "cache:invalidate"
+REAPER_LOCK_KEY = "reaper:lock"
+# counter numbering game creations, part of the ETag of a game's roster
+GAMES_CREATED_KEY = "games:created"
+
+# Lua scripts for the game transitions, each runs as one atomic EVALSHA.
+# ARGV starts with the game key prefix, the cache invalidation channel and the
+# current time; keys of a player's game are derived from the game id stored
+# in the player hash, so that game is read and changed in the same step
+GAME_SCRIPT_HELPERS = """
+local game_key_prefix = ARGV[1]
+local invalidate_channel = ARGV[2]
+local now = tonumber(ARGV[3])
+local written = {}
+
+local function publish_game_event(game_id, data)
+    local game_key = game_key_prefix .. game_id
+    redis.call("PUBLISH", game_key .. ":events", cjson.encode(data))
+    redis.call("HINCRBY", game_key, "version", 1)
+    table.insert(written, game_key)
+end
+
+local function touch_game(game_id, lobby_key)
+    redis.call("HSET", game_key_prefix .. game_id, "last_active", math.floor(now))
+    redis.call("ZADD", lobby_key, "XX", now, game_id)
+end
+
+local function leave_game(username, player_key, games_key, lobby_key, lobby_ids_key)
+    local game_id = redis.call("HGET", player_key, "game_id")
+    redis.call("DEL", player_key)
+    table.insert(written, player_key)
+    if not game_id then
+        return
+    end
+    local game_key = game_key_prefix .. game_id
+    local players_key = game_key .. ":players"
+    redis.call("SREM", players_key, username)
+    table.insert(written, players_key)
+    publish_game_event(game_id, {event = "leave", player = username})
+    if redis.call("SCARD", players_key) == 0 then
+        redis.call("DEL", game_key, players_key)
+        redis.call("SREM", games_key, game_id)
+        redis.call("ZREM", lobby_key, game_id)
+        redis.call("ZREM", lobby_ids_key, game_id)
+    elseif redis.call("HGET", game_key, "host") == username then
+        local remaining = redis.call("SMEMBERS", players_key)
+        table.sort(remaining)
+        redis.call("HSET", game_key, "host", remaining[1])
+    end
+end
+
+local function finish(result)
+    redis.call("PUBLISH", invalidate_channel, cjson.encode(written))
+    result.written = written
+    return cjson.encode(result)
+end
+"""
+
+# KEYS: user, player, games, lobby, lobby ids, games created;
+# ARGV[4..6]: username, game id, pw hash
+# joins the game if its pw hash is the given one, creates it if it does not exist
+JOIN_GAME_SCRIPT = GAME_SCRIPT_HELPERS + """
+local user_key, player_key, games_key = KEYS[1], KEYS[2], KEYS[3]
+local lobby_key, lobby_ids_key, games_created_key = KEYS[4], KEYS[5], KEYS[6]
+local username, game_id, pw_hash = ARGV[4], ARGV[5], ARGV[6]
+local game_key = game_key_prefix .. game_id
+local players_key = game_key .. ":players"
+local stored_pw_hash = redis.call("HGET", game_key, "pw_hash")
+if stored_pw_hash and stored_pw_hash ~= pw_hash then
+    return cjson.encode({status = "exists", pw_hash = stored_pw_hash})
+end
+local player = redis.call("HMGET", player_key, "game_id", "character", "solved")
+local character, solved = player[2], player[3]
+if player[1] ~= game_id then
+    leave_game(username, player_key, games_key, lobby_key, lobby_ids_key)
+    character, solved = false, false
+end
+if not stored_pw_hash then
+    redis.call("SADD", games_key, game_id)
+    redis.call(
+        "HSET", game_key, "host", username, "pw_hash", pw_hash,
+        "created", redis.call("INCR", games_created_key)
+    )
+    redis.call("ZADD", lobby_key, now, game_id)
+    redis.call("ZADD", lobby_ids_key, 0, game_id)
+end
+redis.call("SADD", players_key, username)
+redis.call("HSET", player_key, "game_id", game_id)
+table.insert(written, players_key)
+table.insert(written, player_key)
+publish_game_event(game_id, {
+    event = "join",
+    player = username,
+    name = redis.call("HGET", user_key, "name"),
+    character = character or "-",
+    solved = solved and "true" or "false"
+})
+touch_game(game_id, lobby_key)
+return finish({status = stored_pw_hash and "joined" or "created"})
+"""
+
+# KEYS: player, games, lobby, lobby ids; ARGV[4]: username
+# hands over the host to the first remaining player, removes an empty game
+LEAVE_GAME_SCRIPT = GAME_SCRIPT_HELPERS + """
+leave_game(ARGV[4], KEYS[1], KEYS[2], KEYS[3], KEYS[4])
+return finish({status = "left"})
+"""
+
+# KEYS: games, lobby, lobby ids; ARGV[4..6]: game id, idle time, player key prefix
+# removes a game without players or activity, starts the clock of older games
+EXPIRE_GAME_SCRIPT = GAME_SCRIPT_HELPERS + """
+local games_key, lobby_key, lobby_ids_key = KEYS[1], KEYS[2], KEYS[3]
+local game_id, idle_time, player_key_prefix = ARGV[4], tonumber(ARGV[5]), ARGV[6]
+local game_key = game_key_prefix .. game_id
+local players_key = game_key .. ":players"
+local players = redis.call("SMEMBERS", players_key)
+local last_active = redis.call("HGET", game_key, "last_active")
+if #players > 0 then
+    if not last_active then
+        -- game from before activity was recorded, start the clock now
+        redis.call("HSETNX", game_key, "last_active", math.floor(now))
+        redis.call("ZADD", lobby_key, "NX", now, game_id)
+        table.insert(written, game_key)
+        return finish({status = "started"})
+    end
+    if now - tonumber(last_active) <= idle_time then
+        return cjson.encode({status = "active"})
+    end
+end
+local removed = 0
+for _, player in ipairs(players) do
+    local player_key = player_key_prefix .. player
+    if redis.call("HGET", player_key, "game_id") == game_id then
+        redis.call("DEL", player_key)
+        table.insert(written, player_key)
+        removed = removed + 1
+    end
+    publish_game_event(game_id, {event = "leave", player = player})
+end
+redis.call("DEL", game_key, players_key)
+redis.call("SREM", games_key, game_id)
+redis.call("ZREM", lobby_key, game_id)
+redis.call("ZREM", lobby_ids_key, game_id)
+table.insert(written, game_key)
+table.insert(written, players_key)
+return finish({status = "expired", players = removed})
+"""
+
+# KEYS: player, lobby; ARGV[4..6]: username, game id, character
+# only replaces a solved character or sets a new one
+SET_CHARACTER_SCRIPT = GAME_SCRIPT_HELPERS + """
+local player_key, lobby_key = KEYS[1], KEYS[2]
+local username, game_id, character = ARGV[4], ARGV[5], ARGV[6]
+local player = redis.call("HMGET", player_key, "game_id", "character", "solved")
+if player[1] ~= game_id then
+    return cjson.encode({status = "not_playing"})
+end
+if player[2] and not player[3] then
+    return cjson.encode({status = "taken"})
+end
+redis.call("HSET", player_key, "character", character)
+redis.call("HDEL", player_key, "solved")
+table.insert(written, player_key)
+publish_game_event(game_id, {
+    event = "character", player = username, character = character, solved = "false"
+})
+touch_game(game_id, lobby_key)
+return finish({status = "set"})
+"""
+
+DEFAULT_CONFIG = {
+    # `redis_url` (e.g. redis://host:6379/2) replaces host, port, db and socket
+    "redis_url": None,
+    # read-heavy helpers use one of these if set, e.g. ["redis://replica:6379/2"];
+    # with the local cache enabled only the lobby is read from them, profiles and
+    # rosters fill the cache from the primary so no stale values get cached
+    "redis_replica_urls": (),
+    # ["host:port", ...] to find primary and replicas of `redis_sentinel_service`
+    "redis_sentinels": (),
+    "redis_sentinel_service": "werbinich",
+    "redis_host": "localhost",
+    "redis_port": 6379,
+    "redis_db": 2,
+    "redis_unix_socket": None,
+    "redis_max_connections": 50,
+    "redis_pool_timeout": 20,
+    "redis_socket_timeout": 5,
+    "redis_socket_connect_timeout": 5,
+    "scan_count": 500,
+    "hash_rounds": 29000,
+    "hash_workers": 2,
+    "hash_queue_size": 16,
+    "hash_timeout": 10,
+    "events_max_connections": 1000,
+    "events_heartbeat": 15,
+    "asgi_threads": 32,
+    "session_backend": "redis",
+    "session_ttl": SESSION_TTL,
+    "session_path": None,
+    "session_sweep_interval": 60 * 60,
+    "secret_key": None,
+    "template_bytecode_cache": None,
+    "template_cache_dir": None,
+    "precompile_templates": True,
+    "cached_pages": ("impressum.html", "login.html"),
+    "metrics": True,
+    "slow_request_threshold": None,
+    "game_idle_time": 60 * 60 * 12,
+    "player_idle_time": 60 * 60 * 24,
+    "reaper_interval": None,
+    "lobby_page_size": 20,
+    # local cache of sessions, user profiles and game rosters, 0 turns it off
+    "cache_size": 10000,
+    "cache_ttl": 60,
+    "bind": "127.0.0.1:5000",
+    "workers": 4,
+    # proxies in front of the app whose X-Forwarded-For is trusted for the client IP
+    "proxy_hops": 0,
+    # operation: (requests, seconds), per client IP and per username
+    "rate_limits": {
+        "login": (10, 60),
+        "register": (5, 600),
+        "join_game": (20, 60),
+        "set_new_pw": (5, 60),
+    },
+}
+
+# keys without a default that hold strings, read as such from the environment
+STRING_CONFIG_KEYS = {
+    "redis_url",
+    "redis_unix_socket",
+    "session_path",
+    "secret_key",
+    "template_bytecode_cache",
+    "template_cache_dir",
+}
+
+logger = logging.getLogger("werbinich")
+
+MISSING = object()
+
+request_local = threading.local()
+
+
+def current_trace():
+    """ the `RequestTrace` of the request handled by this thread, if any """
+    return getattr(request_local, "trace", None)
+
+
+class RequestTrace(object):
+    """ collect where a request spends its time """
+
+    def __init__(self, operation):
+        self.operation = operation
+        self.commands = []
+        self.redis_commands = 0
+        self.redis_time = 0.0
+        self.hash_time = 0.0
+        self.render_time = 0.0
+        self.wrote = False
+
+    def add_redis(self, commands, elapsed):
+        """ record one round trip sending `commands` """
+        self.commands.append((" ".join(commands), elapsed))
+        self.redis_commands += len(commands)
+        self.redis_time += elapsed
+
+
+class InstrumentedPipeline(redis.client.Pipeline):
+
+    cache = None
+
+    def execute(self, raise_on_error=True):
+        keys = []
+        if self.cache is not None:
+            keys = self.cache.written_keys([args for args, _ in self.command_stack])
+        if keys:
+            # published with the writes, in the same transaction if there is one
+            self.publish(CACHE_INVALIDATE_CHANNEL, json.dumps(keys))
+        commands = [str(args[0]) for args, _ in self.command_stack]
+        start = time.perf_counter()
+        try:
+            results = super().execute(raise_on_error)
+            if keys:
+                self.cache.invalidate(keys)
+                results = results[:-1]
+            return results
+        finally:
+            trace = current_trace()
+            if trace is not None and commands:
+                trace.add_redis(commands, time.perf_counter() - start)
+
+
+class InstrumentedRedis(redis.StrictRedis):
+    """
+    Redis client recording each round trip in the current request trace,
+    publishes writes to keys of `cache` for invalidation
+    """
+
+    cache = None
+
+    def execute_command(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            result = super().execute_command(*args, **options)
+        finally:
+            trace = current_trace()
+            if trace is not None:
+                trace.add_redis([str(args[0])], time.perf_counter() - start)
+        keys = self.cache.written_keys([args]) if self.cache is not None else []
+        if keys:
+            self.cache.invalidate(keys)
+            self.publish(CACHE_INVALIDATE_CHANNEL, json.dumps(keys))
+        return result
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        pipe = InstrumentedPipeline(
+            self.connection_pool, self.response_callbacks, transaction, shard_hint
+        )
+        pipe.cache = self.cache
+        return pipe
+
+
+class LocalCache(object):
+    """
+    bounded LRU cache with TTL for Redis values of this process, only used
+    while `enabled`, i.e. while it receives the invalidations of all processes
+    """
+
+    # keys read through the cache, writes to them are published for invalidation
+    prefixes = (USER_KEY_PREFIX, PLAYER_KEY_PREFIX, SESSION_KEY_PREFIX, GAME_KEY_PREFIX)
+    write_commands = {
+        "SET", "GETDEL", "DEL", "UNLINK", "RENAME", "RENAMENX",
+        "HSET", "HMSET", "HSETNX", "HDEL", "HINCRBY", "SADD", "SREM",
+    }
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.pending = {}
+        self.enabled = False
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def written_keys(self, commands):
+        """ keys of cached kinds written by `commands`, a list of command args """
+        keys = []
+        for args in commands:
+            command = str(args[0]).upper()
+            if command not in self.write_commands:
+                continue
+            if command in ("DEL", "UNLINK"):
+                written = args[1:]
+            elif command in ("RENAME", "RENAMENX"):
+                written = args[1:3]
+            else:
+                written = args[1:2]
+            keys.extend(key for key in written if key.startswith(self.prefixes))
+        return keys
+
+    def get(self, key):
+        """
+        get `(value, None)` for a hit or `(MISSING, token)` for a miss,
+        pass the token to `set` to store the loaded value
+        """
+        if not self.enabled:
+            return MISSING, None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0], None
+            self.entries.pop(key, None)
+            self.misses += 1
+            token = self.pending[key] = object()
+            return MISSING, token
+
+    def set(self, key, value, token):
+        """ store a loaded value unless `key` was invalidated while loading it """
+        if token is None:
+            return
+        with self.lock:
+            if self.pending.get(key) is not token:
+                return
+            del self.pending[key]
+            self.entries[key] = (value, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def fetch_many(self, keys, load):
+        """
+        get the values of `keys` from the cache, `load(missing_keys)`
+        returns the values of the misses in the same order
+        """
+        values = {}
+        misses = {}
+        for key in keys:
+            value, token = self.get(key)
+            if value is MISSING:
+                misses[key] = token
+            else:
+                values[key] = value
+        if misses:
+            for (key, token), value in zip(misses.items(), load(list(misses))):
+                values[key] = value
+                self.set(key, value, token)
+        return [values[key] for key in keys]
+
+    def fetch(self, key, load):
+        """ get the value of `key` from the cache or `load()` and store it """
+        value, token = self.get(key)
+        if value is MISSING:
+            value = load()
+            self.set(key, value, token)
+        return value
+
+    def invalidate(self, keys):
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+                self.pending.pop(key, None)
+                self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.pending.clear()
+
+    def render(self):
+        """ hit/miss stats in Prometheus text format """
+        lines = []
+        with self.lock:
+            counters = (
+                ("werbinich_cache_hits_total", "Local cache hits.", self.hits),
+                ("werbinich_cache_misses_total", "Local cache misses.", self.misses),
+                ("werbinich_cache_evictions_total", "Local cache evictions.", self.evictions),
+                ("werbinich_cache_invalidations_total", "Local cache invalidations.",
+                 self.invalidations),
+            )
+            entries = len(self.entries)
+        for name, description, value in counters:
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name} {value}")
+        lines.append("# HELP werbinich_cache_entries Local cache entries.")
+        lines.append("# TYPE werbinich_cache_entries gauge")
+        lines.append(f"werbinich_cache_entries {entries}")
+        return "\n".join(lines) + "\n"
+
+
+class Metrics(object):
+    """ per operation request metrics of this process in Prometheus text format """
+
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    counters = (
+        ("werbinich_redis_round_trips_total", "Redis round trips."),
+        ("werbinich_redis_commands_total", "Redis commands."),
+        ("werbinich_redis_seconds_total", "Time spent waiting for Redis."),
+        ("werbinich_hash_seconds_total", "Time spent hashing passwords."),
+        ("werbinich_render_seconds_total", "Time spent rendering templates."),
+    )
 
     def __init__(self):
-        self.redis = redis.StrictRedis(decode_responses=True, db=2)
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.totals = {}
+
+    def observe(self, trace, duration):
+        values = (
+            len(trace.commands),
+            trace.redis_commands,
+            trace.redis_time,
+            trace.hash_time,
+            trace.render_time,
+        )
+        with self.lock:
+            histogram = self.histograms.setdefault(
+                trace.operation, [0] * len(self.buckets) + [0, 0.0]
+            )
+            for i, bound in enumerate(self.buckets):
+                if duration <= bound:
+                    histogram[i] += 1
+            histogram[-2] += 1
+            histogram[-1] += duration
+            totals = self.totals.setdefault(trace.operation, [0] * len(values))
+            for i, value in enumerate(values):
+                totals[i] += value
+
+    def render(self):
+        name = "werbinich_request_duration_seconds"
+        lines = [
+            f"# HELP {name} Request latency by operation.",
+            f"# TYPE {name} histogram",
+        ]
+        with self.lock:
+            histograms = {op: list(values) for op, values in self.histograms.items()}
+            totals = {op: list(values) for op, values in self.totals.items()}
+        for operation, histogram in sorted(histograms.items()):
+            for bound, count in zip(self.buckets, histogram):
+                lines.append(f'{name}_bucket{{operation="{operation}",le="{bound}"}} {count}')
+            lines.append(f'{name}_bucket{{operation="{operation}",le="+Inf"}} {histogram[-2]}')
+            lines.append(f'{name}_count{{operation="{operation}"}} {histogram[-2]}')
+            lines.append(f'{name}_sum{{operation="{operation}"}} {histogram[-1]}')
+        for i, (counter, description) in enumerate(self.counters):
+            lines.append(f"# HELP {counter} {description}")
+            lines.append(f"# TYPE {counter} counter")
+            for operation, values in sorted(totals.items()):
+                lines.append(f'{counter}{{operation="{operation}"}} {values[i]}')
+        return "\n".join(lines) + "\n"
+
+
+def hash_pw(password, rounds):
+    """ hash a pw, runs in a worker process of the `HashingPool` """
+    return sha256.using(rounds=rounds).hash(password)
+
+
+def verify_pw(password, pw_hash):
+    """ verify a pw, runs in a worker process of the `HashingPool` """
+    return sha256.verify(password, pw_hash)
+
+
+class HashingPoolBusy(ServiceUnavailable):
+    description = "Der Server ist gerade ausgelastet. Bitte versuche es gleich noch einmal."
+
+
+class HashingPool(object):
+    """
+    run pw hashing in a bounded pool of worker processes,
+    with `workers` set to 0 hashing runs in the request thread
+    """
+
+    def __init__(self, rounds, workers, queue_size, timeout):
+        self.hasher = sha256.using(rounds=rounds)
+        self.workers = workers
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(workers + queue_size)
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def get_executor(self):
+        """
+        start the worker processes on first use, without forking the threads
+        already running in this process
+        """
+        with self.lock:
+            if self.executor is None:
+                methods = multiprocessing.get_all_start_methods()
+                self.executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context(
+                        "forkserver" if "forkserver" in methods else "spawn"
+                    )
+                )
+            return self.executor
+
+    def discard_executor(self, executor):
+        """ drop a pool whose worker died, the next call starts a new one """
+        with self.lock:
+            if self.executor is executor:
+                self.executor = None
+        executor.shutdown(wait=False)
+
+    def run(self, fn, *args):
+        """ run `fn` in the pool and record the time in the request trace """
+        start = time.perf_counter()
+        try:
+            return self.submit(fn, *args)
+        finally:
+            trace = current_trace()
+            if trace is not None:
+                trace.hash_time += time.perf_counter() - start
+
+    def submit(self, fn, *args):
+        """ run `fn` in the pool, reject if all workers and queue slots are taken """
+        if not self.workers:
+            return fn(*args)
+        if not self.slots.acquire(blocking=False):
+            raise HashingPoolBusy(retry_after=1)
+        executor = self.get_executor()
+        try:
+            future = executor.submit(fn, *args)
+        except BrokenProcessPool:
+            self.slots.release()
+            self.discard_executor(executor)
+            raise HashingPoolBusy(retry_after=1)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            raise HashingPoolBusy(retry_after=1)
+        except BrokenProcessPool:
+            self.discard_executor(executor)
+            raise HashingPoolBusy(retry_after=1)
+
+    def hash(self, password):
+        return self.run(hash_pw, password, self.hasher.default_rounds)
+
+    def verify(self, password, pw_hash):
+        return self.run(verify_pw, password, pw_hash)
+
+    def needs_update(self, pw_hash):
+        """ check whether a hash was made with outdated parameters """
+        return self.hasher.needs_update(pw_hash)
+
+    def shutdown(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
+
+
+class RateLimitExceeded(TooManyRequests):
+    description = "Zu viele Versuche. Bitte warte einen Moment."
+
+
+class RateLimiter(object):
+    """
+    sliding window limits per operation, counted in Redis per client
+    IP and username, `limits` maps operations to `(requests, seconds)`
+    """
+
+    def __init__(self, redis_client, limits):
+        self.redis = redis_client
+        self.limits = limits
+
+    def key(self, operation, identity, window):
+        return f"{RATE_LIMIT_KEY_PREFIX}{operation}:{identity}:{window}"
+
+    def check(self, operation, **identities):
+        """
+        count an attempt for each identity, raise `RateLimitExceeded` if one
+        of them is over the limit, costs one pipelined round trip
+        """
+        if operation not in self.limits:
+            return
+        limit, period = self.limits[operation]
+        now = time.time()
+        window, elapsed = divmod(now, period)
+        identities = [f"{scope}:{value}" for scope, value in identities.items() if value]
+        pipe = self.redis.pipeline(transaction=False)
+        for identity in identities:
+            current_key = self.key(operation, identity, int(window))
+            pipe.incr(current_key)
+            pipe.expire(current_key, period * 2)
+            pipe.get(self.key(operation, identity, int(window) - 1))
+        results = pipe.execute()
+        retry_after = 0
+        for current, previous in zip(results[::3], results[2::3]):
+            previous = int(previous or 0)
+            # weight the previous window by how much of it is still in the sliding window
+            if previous * (1 - elapsed / period) + current <= limit:
+                continue
+            if current >= limit or not previous:
+                wait = period - elapsed
+            else:
+                wait = period * (1 - (limit - current) / previous) - elapsed
+            retry_after = max(retry_after, math.ceil(wait), 1)
+        if retry_after:
+            raise RateLimitExceeded(retry_after=retry_after)
+
+
+class RedisSessionStore(SessionStore):
+    """
+    keep session data in a Redis hash next to the user data,
+    the hash expires `ttl` seconds after the last access
+    """
+
+    def __init__(self, redis_client, ttl, session_class=Session, cache=None):
+        super().__init__(session_class)
+        self.redis = redis_client
+        self.ttl = ttl
+        self.cache = cache
+
+    def key(self, sid):
+        return f"{SESSION_KEY_PREFIX}{sid}:data"
+
+    def save(self, session):
+        key = self.key(session.sid)
+        pipe = self.redis.pipeline()
+        pipe.delete(key)
+        if session:
+            pipe.hset(
+                key,
+                mapping={name: json.dumps(value) for name, value in session.items()}
+            )
+            pipe.expire(key, self.ttl)
+        pipe.execute()
+
+    def delete(self, session):
+        self.redis.delete(self.key(session.sid))
+
+    def get(self, sid):
+        if not self.is_valid_key(sid):
+            return self.new()
+        key = self.key(sid)
+
+        def load():
+            pipe = self.redis.pipeline()
+            pipe.hgetall(key)
+            pipe.expire(key, self.ttl)
+            data, _ = pipe.execute()
+            return data
+
+        data = load() if self.cache is None else self.cache.fetch(key, load)
+        data = {name: json.loads(value) for name, value in data.items()}
+        return self.session_class(data, sid, False)
+
+    def sid_from_cookie(self, value):
+        """ get the session id from the cookie value without any I/O """
+        return value if value and self.is_valid_key(value) else None
+
+    def cookie_value(self, session):
+        return session.sid
+
+    def sweep(self):
+        """ expired hashes are removed by Redis """
+        return 0
+
+
+class SignedCookieSessionStore(SessionStore):
+    """
+    keep session data and session id in a signed cookie,
+    nothing is stored on the server
+    """
+
+    def __init__(self, secret_key, ttl, session_class=Session):
+        super().__init__(session_class)
+        if not secret_key:
+            raise ValueError("the signed cookie session store needs a `secret_key`")
+        self.secret_key = secret_key
+        self.ttl = ttl
+
+    def get(self, value):
+        data = dict(SecureCookie.unserialize(value or "", self.secret_key))
+        sid = data.pop("sid", None)
+        if sid is None or not self.is_valid_key(sid):
+            return self.new()
+        return self.session_class(data, sid, False)
+
+    def sid_from_cookie(self, value):
+        if not value:
+            return None
+        sid = SecureCookie.unserialize(value, self.secret_key).get("sid")
+        return sid if sid and self.is_valid_key(sid) else None
+
+    def cookie_value(self, session):
+        cookie = SecureCookie(dict(session, sid=session.sid), self.secret_key)
+        expires = datetime.utcnow() + timedelta(seconds=self.ttl)
+        return cookie.serialize(expires=expires).decode("ascii")
+
+    def sweep(self):
+        """ expired cookies are rejected when read """
+        return 0
+
+
+class ExpiringFilesystemSessionStore(FilesystemSessionStore):
+    """
+    the session store of a single host, session files are removed
+    lazily once they were not modified for `ttl` seconds
+    """
+
+    def __init__(self, path, ttl, sweep_interval, session_class=Session):
+        super().__init__(path, session_class=session_class)
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self.last_sweep = time.monotonic()
+
+    def get(self, sid):
+        if time.monotonic() - self.last_sweep > self.sweep_interval:
+            self.last_sweep = time.monotonic()
+            self.sweep()
+        return super().get(sid)
+
+    def sid_from_cookie(self, value):
+        return value if value and self.is_valid_key(value) else None
+
+    def cookie_value(self, session):
+        return session.sid
+
+    def sweep(self):
+        """ remove expired session files, return how many were removed """
+        count = 0
+        expired = time.time() - self.ttl
+        for sid in self.list():
+            filename = self.get_session_filename(sid)
+            try:
+                if os.path.getmtime(filename) < expired:
+                    os.remove(filename)
+                    count += 1
+            except OSError:
+                pass
+        return count
+
+
+def create_session_store(config, redis_client, cache=None):
+    """ create the session store selected by `config["session_backend"]` """
+    backend = config["session_backend"]
+    ttl = config["session_ttl"]
+    if backend == "redis":
+        return RedisSessionStore(redis_client, ttl, cache=cache)
+    if backend == "cookie":
+        return SignedCookieSessionStore(config["secret_key"], ttl)
+    if backend == "filesystem":
+        return ExpiringFilesystemSessionStore(
+            config["session_path"], ttl, config["session_sweep_interval"]
+        )
+    raise ValueError(f"unknown session backend {backend!r}")
+
+
+class RedisBytecodeCache(BytecodeCache):
+    """ share compiled templates between worker processes through Redis """
+
+    def __init__(self, redis_client, prefix="template:"):
+        self.redis = redis_client
+        self.prefix = prefix
+
+    def load_bytecode(self, bucket):
+        code = self.redis.get(self.prefix + bucket.key)
+        if code is not None:
+            bucket.bytecode_from_string(code)
+
+    def dump_bytecode(self, bucket):
+        self.redis.set(self.prefix + bucket.key, bucket.bytecode_to_string())
+
+
+def create_bytecode_cache(config):
+    """ create the cache selected by `config["template_bytecode_cache"]` """
+    backend = config["template_bytecode_cache"]
+    if backend is None:
+        return None
+    if backend == "filesystem":
+        return FileSystemBytecodeCache(config["template_cache_dir"])
+    if backend == "redis":
+        return RedisBytecodeCache(redis.StrictRedis(
+            connection_pool=create_connection_pool(config, decode_responses=False)
+        ))
+    raise ValueError(f"unknown template bytecode cache {backend!r}")
+
+
+class Werbinich(object):
+
+    def __init__(self, config=None):
+        self.config = dict(DEFAULT_CONFIG, **(config or {}))
+        self.redis = InstrumentedRedis(
+            connection_pool=create_connection_pool(self.config)
+        )
+        replica_pool = create_connection_pool(self.config, replica=True)
+        self.replica_redis = self.redis
+        if replica_pool is not None:
+            self.replica_redis = InstrumentedRedis(connection_pool=replica_pool)
+        self.metrics = Metrics()
+        self.cache = LocalCache(self.config["cache_size"], self.config["cache_ttl"])
+        self.redis.cache = self.cache
+        self.scripts = {
+            "join_game": self.redis.register_script(JOIN_GAME_SCRIPT),
+            "leave_game": self.redis.register_script(LEAVE_GAME_SCRIPT),
+            "set_character": self.redis.register_script(SET_CHARACTER_SCRIPT),
+            "expire_game": self.redis.register_script(EXPIRE_GAME_SCRIPT),
+        }
+        self.events_redis = redis.StrictRedis(
+            connection_pool=create_connection_pool(
+                self.config,
+                max_connections=self.config["events_max_connections"]
+            )
+        )
+        self.session_store = create_session_store(self.config, self.redis, self.cache)
+        self.rate_limiter = RateLimiter(self.redis, self.config["rate_limits"])
+        self.hashing = HashingPool(
+            self.config["hash_rounds"],
+            self.config["hash_workers"],
+            self.config["hash_queue_size"],
+            self.config["hash_timeout"]
+        )
         template_path = os.path.join(os.path.dirname(__file__), 'templates')
         self.jinja_env = Environment(loader=FileSystemLoader(template_path),
-                                 autoescape=True)
+                                 autoescape=True,
+                                 bytecode_cache=create_bytecode_cache(self.config))
+        self.jinja_env.globals["static_url"] = self.static_url
+        self.page_cache = {}
         self.url_map = Map([
             Rule('/', endpoint='load'),
+            Rule('/events', endpoint='events'),
+            Rule('/metrics', endpoint='metrics'),
+            Rule('/healthz', endpoint='healthz'),
+            Rule('/readyz', endpoint='readyz'),
+            Rule(
+                '/api/v1/games/<game_id>/players',
+                endpoint='api_players',
+                methods=['GET', 'PATCH']
+            ),
+            Rule(
+                '/api/v1/games/<game_id>/players/<player>/solved',
+                endpoint='api_player_solved',
+                methods=['POST']
+            ),
+            Rule(
+                '/api/v1/games/<game_id>/players/<player>/character',
+                endpoint='api_player_character',
+                methods=['POST']
+            ),
         ])
 
     def render_template(self, template_name, **context):
-        t = self.jinja_env.get_template(template_name)
-        return Response(t.render(context), mimetype='text/html')
+        if template_name in self.config["cached_pages"]:
+            return self.render_cached_page(template_name, context)
+        return Response(self.render(template_name, context), mimetype='text/html')
+
+    def render(self, template_name, context):
+        """ render a template and record the time in the request trace """
+        start = time.perf_counter()
+        try:
+            return self.jinja_env.get_template(template_name).render(context)
+        finally:
+            trace = current_trace()
+            if trace is not None:
+                trace.render_time += time.perf_counter() - start
+
+    def render_cached_page(self, template_name, context):
+        """
+        render pages without user data once per context,
+        serve them with an ETag
+        """
+        if not all(value is None or isinstance(value, (str, bool)) for value in context.values()):
+            return Response(self.render(template_name, context), mimetype='text/html')
+        key = (template_name, tuple(sorted(context.items())))
+        page = self.page_cache.get(key)
+        if page is None:
+            body = self.render(template_name, context)
+            etag = hashlib.sha1(body.encode()).hexdigest()
+            page = self.page_cache[key] = (body, etag)
+        body, etag = page
+        response = Response(body, mimetype='text/html')
+        response.set_etag(etag)
+        return response
+
+    def static_url(self, filename):
+        """ URL of a static file, replaced with fingerprinted URLs when serving them """
+        return f"/static/{filename}"
+
+    def precompile_templates(self):
+        """ compile all templates, filling the bytecode cache if configured """
+        for template_name in self.jinja_env.list_templates():
+            self.jinja_env.get_template(template_name)
 
     def dispatch_request(self, request):
         adapter = self.url_map.bind_to_environ(request.environ)
@@ -40,34 +1028,264 @@ class Werbinich(object):
             endpoint, values = adapter.match()
             return getattr(self, f'on_{endpoint}')(request, **values)
         except HTTPException as e:
+            if request.path.startswith('/api/'):
+                response = e.get_response(request.environ)
+                response.set_data(json.dumps(
+                    {"error": e.description}, separators=(",", ":"), ensure_ascii=False
+                ))
+                response.mimetype = 'application/json'
+                return response
             return e
 
     def wsgi_app(self, environ, start_response):
         request = Request(environ)
-        response = self.dispatch_request(request)
+        trace = request_local.trace = RequestTrace(self.operation_name(request))
+        start = time.perf_counter()
+        try:
+            response = self.dispatch_request(request)
+        finally:
+            request_local.trace = None
+            self.record_request(trace, time.perf_counter() - start)
+        if request.method in ("GET", "HEAD") and isinstance(response, Response):
+            response.make_conditional(request)
         return response(environ, start_response)
 
+    def operation_name(self, request):
+        """ metrics label of a request: the form operation or the endpoint """
+        try:
+            endpoint, _ = self.url_map.bind_to_environ(request.environ).match()
+        except HTTPException:
+            return "not_found"
+        if endpoint == "load" and request.method == "POST":
+            op = request.form.get("operation")
+            if op and not op.startswith("_") and callable(getattr(self, op, None)):
+                return op
+            return "unknown"
+        return endpoint
+
+    def record_request(self, trace, duration):
+        """ add a finished request to the metrics, log it if it was slow """
+        self.metrics.observe(trace, duration)
+        threshold = self.config["slow_request_threshold"]
+        if threshold is not None and duration > threshold:
+            logger.warning(
+                "slow request %s: %.1f ms, redis %.1f ms in %d round trips, "
+                "hash %.1f ms, render %.1f ms, trace: %s",
+                trace.operation,
+                duration * 1000,
+                trace.redis_time * 1000,
+                len(trace.commands),
+                trace.hash_time * 1000,
+                trace.render_time * 1000,
+                ", ".join(f"{commands} ({elapsed * 1000:.1f} ms)" for commands, elapsed in trace.commands)
+            )
+
+    def on_metrics(self, request):
+        """ expose the metrics of this process for Prometheus """
+        if not self.config["metrics"]:
+            raise NotFound()
+        return Response(
+            self.metrics.render() + self.cache.render(),
+            mimetype='text/plain; version=0.0.4'
+        )
+
+    def on_healthz(self, request):
+        """ liveness: this worker answers and reaches the Redis primary """
+        return self.health_response([self.redis])
+
+    def on_readyz(self, request):
+        """ readiness: the primary and the replica for reads answer """
+        return self.health_response([self.redis, self.replica_redis])
+
+    def health_response(self, clients):
+        try:
+            for client in clients:
+                client.ping()
+        except redis.RedisError as e:
+            logger.warning("health check failed: %s", e)
+            return Response("unavailable\n", status=503, mimetype='text/plain')
+        return Response("ok\n", mimetype='text/plain')
+
     def __call__(self, environ, start_response):
         return self.wsgi_app(environ, start_response)
 
     def on_load(self, request):
         """ Handle all form submit events """
         error=None
-        sid = request.cookies.get('session_id')
-        if sid is None:
-            request.session = session_store.new()
+        cookie = request.cookies.get('session_id')
+        if cookie is None:
+            request.session = self.session_store.new()
+            sid = None
         else:
-            request.session = session_store.get(sid)
+            request.session = self.session_store.get(cookie)
+            sid = request.session.sid
         username = self.get_user(sid)
         if request.method == 'POST':
             op = request.form["operation"]
             if username != "None" or op in ["login", "register", "registration_form"]:
+                self.rate_limiter.check(
+                    op,
+                    ip=request.remote_addr,
+                    user=request.form.get("username") if username == "None" else username
+                )
                 return getattr(self, op)(request, sid)  # call operation method
             else:
                 return self.render_template('login.html', error=error)
         response = self.render_template('login.html', error=error)
         return response
 
+    def on_events(self, request):
+        """ stream changes in the game of the session user as Server-Sent Events """
+        username = self.get_user(
+            self.session_store.sid_from_cookie(request.cookies.get('session_id'))
+        )
+        game_id = None
+        if username != "None":
+            game_id = self.get_game_id(username)
+        if not game_id:
+            return Response(status=204)  # tells EventSource not to reconnect
+        return Response(
+            self.stream_game_events(game_id, username),
+            mimetype='text/event-stream',
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
+
+    def stream_game_events(self, game_id, username):
+        """
+        yield the events published for a game to `username`, with heartbeats
+        while idle
+        """
+        pubsub = self.events_redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self.game_events_key(game_id))
+        try:
+            while True:
+                message = pubsub.get_message(
+                    timeout=self.config["events_heartbeat"]
+                )
+                if message is None:
+                    yield ": ping\n\n"
+                elif self.event_visible_to(message["data"], username):
+                    yield f"data: {message['data']}\n\n"
+        finally:
+            pubsub.close()
+
+    def event_visible_to(self, event, username):
+        """ events about a player are not sent to them, they would show their character """
+        return json.loads(event).get("player") != username
+
+    def on_api_players(self, request, game_id):
+        """ roster of a game as JSON, `PATCH` applies a batch of player updates """
+        username, etag = self.api_session_game(request, game_id)
+        if request.method == "PATCH":
+            updates = request.get_json(silent=True)
+            if not isinstance(updates, list):
+                raise BadRequest("Das funktioniert nicht.")
+            return self.api_update_players(username, game_id, updates)
+        if request.if_none_match.contains(etag):
+            return Response(status=304, headers={"ETag": f'"{etag}"'})
+        host, version, created, players = self.get_game_roster(game_id)
+        # players do not get to see their own character
+        players.get(username, {}).pop("character", None)
+        response = self.json_response(
+            {"game": game_id, "version": version, "host": host, "players": players}
+        )
+        response.set_etag(self.game_etag(game_id, version, created))
+        return response
+
+    def on_api_player_solved(self, request, game_id, player):
+        """ set the solved flag of a player from `{"solved": bool}` """
+        username, _ = self.api_session_game(request, game_id)
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            raise BadRequest("Das funktioniert nicht.")
+        return self.api_update_players(
+            username, game_id, [{"username": player, "solved": data.get("solved")}]
+        )
+
+    def on_api_player_character(self, request, game_id, player):
+        """ set the character of a player from `{"character": str}` """
+        username, _ = self.api_session_game(request, game_id)
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            raise BadRequest("Das funktioniert nicht.")
+        return self.api_update_players(
+            username, game_id, [{"username": player, "character": data.get("character")}]
+        )
+
+    def api_session_game(self, request, game_id):
+        """ user of the session and ETag of the game roster, if they play in `game_id` """
+        username = self.get_user(
+            self.session_store.sid_from_cookie(request.cookies.get('session_id'))
+        )
+        if username == "None":
+            raise Unauthorized("Bitte melde dich an.")
+        if self.get_profiles([username])[0]["game_id"] != game_id:
+            raise Forbidden("Du spielst nicht in diesem Spiel.")
+        _, version, created = self.get_game_info(game_id)
+        return username, self.game_etag(game_id, version, created)
+
+    def api_update_players(self, username, game_id, updates):
+        """
+        apply `[{"username", "solved"?, "character"?}]` to other players of
+        the game in one transaction, respond with the new version
+        """
+        for update in updates:
+            if (
+                not isinstance(update, dict) or
+                not isinstance(update.get("username"), str) or
+                update["username"] == username or
+                not isinstance(update.get("solved", False), bool) or
+                not isinstance(update.get("character", ""), str) or
+                not update.get("character", "x").strip() or
+                not {"solved", "character"} & update.keys()
+            ):
+                raise BadRequest("Das funktioniert nicht.")
+        players_key = self.game_players_key(game_id)
+        player_keys = [self.player_key(update["username"]) for update in updates]
+        # retried if the players change between the checks and the writes
+        for _ in range(5):
+            with self.transaction() as pipe:
+                try:
+                    pipe.watch(players_key, *player_keys)
+                    game_players = pipe.smembers(players_key)
+                    rows = [pipe.hmget(key, "character", "solved") for key in player_keys]
+                    pipe.multi()
+                    for update, (character, solved) in zip(updates, rows):
+                        player = update["username"]
+                        if player not in game_players:
+                            raise NotFound("Diese Person spielt nicht in diesem Spiel.")
+                        if "character" in update:
+                            if character is not None and solved is None:
+                                raise Conflict("Da steht schon ein Charakter.")
+                            self.set_character(
+                                pipe, game_id, player, update["character"].strip()
+                            )
+                        if "solved" in update:
+                            self.set_solved(pipe, game_id, player, update["solved"])
+                    self.touch_game(pipe, game_id)
+                    pipe.hmget(self.game_key(game_id), "version", "created")
+                    version, created = pipe.execute()[-1]
+                    break
+                except redis.WatchError:
+                    continue
+        else:
+            raise Conflict("Das hat nicht geklappt.")
+        version = int(version or 0)
+        response = self.json_response({"game": game_id, "version": version})
+        response.set_etag(self.game_etag(game_id, version, created or 0))
+        return response
+
+    def game_etag(self, game_id, version, created):
+        """ `created` tells apart games that reuse the id of a removed game """
+        return f"{game_id}-{created}-{version}"
+
+    def json_response(self, data, status=200):
+        return Response(
+            json.dumps(data, separators=(",", ":"), ensure_ascii=False),
+            status=status,
+            mimetype='application/json'
+        )
+
     def login(self, request, sid):
         """ Handle user login """
         args = list(request.form.keys())
@@ -77,42 +1295,45 @@ class Werbinich(object):
             return self.render_template('login.html', error=error)
         username = request.form["username"].strip()
         pw = request.form["login_pw"].strip()
-        pw_hash = self.get_user_pw(username)
-        if pw_hash and sha256.verify(pw, pw_hash):
-            self.set_user_session(username, request.session.sid)
-            if self.redis.hexists(username, "change_pw"):
+        reads = self.redis.pipeline(transaction=False)
+        reads.hmget(self.user_key(username), "pw_hash", "change_pw", "session_id")
+        reads.hget(self.player_key(username), "game_id")
+        (pw_hash, change_pw, old_session_id), saved_game_id = reads.execute()
+        if pw_hash and self.hashing.verify(pw, pw_hash):
+            pipe = self.transaction()
+            self.set_user_session(
+                username, request.session.sid, old_session_id, pipe=pipe
+            )
+            if self.hashing.needs_update(pw_hash):
+                self.set_user_pw(username, pw, pipe=pipe)
+            if change_pw is not None:
+                pipe.hdel(self.user_key(username), "change_pw")
+                pipe.execute()
                 response = self.render_template("change_pw.html")
-                response.set_cookie("session_id", request.session.sid)
-                self.redis.hdel(username, "change_pw")
+                self.save_session(request, response)
                 return response
-            games_list = self.get_list_of_games()
+            pipe.execute()
             success = "Angemeldet."
-            if self.redis.hexists(username, "game_id"):
-                saved_game_id = self.redis.hget(username, "game_id")
-                if saved_game_id != "None":
-                    success = "Spiel beigetreten."
-                    player_list = self.get_other_players(username)
-                    response = self.render_template(
-                        'game.html',
-                        error=None,
-                        success=success,
-                        player_list=player_list,
-                        username=username,
-                        game_id=saved_game_id
-                    )
-                    self.set_user_session(username, request.session.sid)
-                    response.set_cookie("session_id", request.session.sid)
-                    return response
+            if saved_game_id:
+                success = "Spiel beigetreten."
+                player_list = self.get_other_players(username, saved_game_id)
+                response = self.render_template(
+                    'game.html',
+                    error=None,
+                    success=success,
+                    player_list=player_list,
+                    username=username,
+                    game_id=saved_game_id
+                )
+                self.save_session(request, response)
+                return response
             response = self.render_template(
                 'index.html',
                 error=None,
                 success=success,
                 username=username
             )
-            if request.session.should_save:
-                session_store.save(request.session)
-            self.set_user_session(username, request.session.sid)
-            response.set_cookie("session_id", request.session.sid)
+            self.save_session(request, response)
             return response
         elif pw_hash:
             error = "Falsches Passwort."
@@ -135,16 +1356,17 @@ class Werbinich(object):
             error = "Das funktioniert nicht."
             return self.render_template('login.html', error=error)
         username = request.form["username"].strip()
-        keys = self.get_all_keys()
-        if username in keys:
+        if self.redis.exists(self.user_key(username)):
             error = "Diese:r Nutzer:in existiert bereits."
             return self.render_template('registration_form.html', error=error)
         name = request.form["name"].strip()
         pw = request.form["pw"].strip()
         pw_confirm = request.form["pw_confirm"].strip()
         if pw == pw_confirm and validate_pw(pw) and validate_username(username) and validate_username(username):
-            self.set_user_name_and_pw(username, name, pw)
-            games_list = self.get_list_of_games()
+            pipe = self.transaction()
+            self.set_user_name_and_pw(username, name, pw, pipe=pipe)
+            self.set_user_session(username, request.session.sid, None, pipe=pipe)
+            pipe.execute()
             success = "Registriert und angemeldet."
             response = self.render_template(
                 'index.html',
@@ -152,10 +1374,7 @@ class Werbinich(object):
                 success=success,
                 username=username
             )
-            self.set_user_session(username, request.session.sid)
-            if request.session.should_save:
-                session_store.save(request.session)
-            response.set_cookie("session_id", request.session.sid)
+            self.save_session(request, response)
         else:
             error = "Die Passwörter stimmen nicht überein."
             response = self.render_template('registration_form.html', error=error)
@@ -173,49 +1392,36 @@ class Werbinich(object):
         game_pw = request.form["game_pw"].strip()
         if not validate_username(game_id):
             error = "Bitte gib gültige Daten ein."
-            games_list = self.get_list_of_games()
-            return self.render_template(
-                'join_game.html',
-                error=error,
-                game_list=games_list
-            )
-        games_list = self.get_list_of_games()
-        if game_id in games_list:# if game exists
-            pw_hash = self.get_game_pw(game_id)
-            if sha256.verify(game_pw, pw_hash):#... and pw is correct
-                self.redis.hset(session_user_name, "game_id", game_id)
-                player_list = self.get_other_players(session_user_name)
-                success = "Spiel beigetreten."
-                response = self.render_template(
-                    'game.html',
-                    error=None,
-                    success=success,
-                    player_list=player_list,
-                    username=session_user_name,
-                    game_id=game_id
-                )
-            else:# game exists, pw incorrect
-                response = self.render_template(
-                    'join_game.html',
+            return self.render_lobby(request, error=error)
+        pw_hash = self.get_game_pw(game_id)
+        # retried if the game is created or replaced in the meantime
+        for _ in range(3):
+            if pw_hash is None:# create game
+                pw_hash = self.hashing.hash(game_pw)
+            elif not self.hashing.verify(game_pw, pw_hash):# game exists, pw incorrect
+                return self.render_lobby(
+                    request,
                     error="Falsches Passwort",
-                    game_list=games_list,
                     username=session_user_name
                 )
+            status, pw_hash = self.add_player_to_game(session_user_name, game_id, pw_hash)
+            if status != "exists":
+                break
         else:
-            # create game
-            self.redis.hset(session_user_name, "game_host", "true")
-            pw_hash = sha256.hash(game_pw)
-            self.redis.hset(session_user_name, "game_pw", pw_hash)
-            self.redis.hset(session_user_name, "game_id", game_id)
-            player_list = self.get_other_players(session_user_name)
-            response = self.render_template(
-                    'game.html',
-                    error=None,
-                    success="Spiel erstellt!",
-                    player_list=player_list,
-                    username=session_user_name,
-                    game_id=game_id
-                )
+            return self.render_lobby(
+                request,
+                error="Das hat nicht geklappt.",
+                username=session_user_name
+            )
+        player_list = self.get_other_players(session_user_name, game_id)
+        response = self.render_template(
+            'game.html',
+            error=None,
+            success="Spiel erstellt!" if status == "created" else "Spiel beigetreten.",
+            player_list=player_list,
+            username=session_user_name,
+            game_id=game_id
+        )
         return response
 
     def set_player_character(self, request, sid):
@@ -230,15 +1436,15 @@ class Werbinich(object):
         session_user_name = self.get_user(request.session.sid)
         player_id = request.form["player"]
         player_character = request.form["character"].strip()
-        old_character = self.redis.hget(player_id, "character")
-        character_solved = self.redis.hget(player_id, "solved")
-        if old_character is None or str(old_character) == "None" or character_solved == "true":
-            self.redis.hset(player_id, "character", player_character)
-            self.redis.hset(player_id, "solved", "false")
-        else:
+        game_id = self.get_profiles([session_user_name])[0]["game_id"]
+        status = "not_playing"
+        if game_id:
+            status = self.set_character_if_empty(game_id, player_id, player_character)
+        if status == "not_playing":
+            error = "Das funktioniert nicht."
+        elif status == "taken":
             error = "Da steht schon ein Charakter."
-        game_id = self.redis.hget(player_id, "game_id")
-        player_list = self.get_other_players(session_user_name)
+        player_list = self.get_other_players(session_user_name, game_id)
         response = self.render_template(
             'game.html',
             error=error,
@@ -252,8 +1458,8 @@ class Werbinich(object):
     def reload_game(self, request, sid):
         """ reload other players in game """
         session_user_name = self.get_user(request.session.sid)
-        player_list = self.get_other_players(session_user_name)
-        game_id = self.redis.hget(session_user_name, "game_id")
+        game_id = self.get_profiles([session_user_name])[0]["game_id"]
+        player_list = self.get_other_players(session_user_name, game_id)
         response = self.render_template(
             'game.html',
             error=None,
@@ -267,31 +1473,22 @@ class Werbinich(object):
     def leave_game(self, request, sid):
         """ leave game and transfer host if necessary """
         session_user_name = self.get_user(request.session.sid)
-        if self.redis.hexists(session_user_name, "game_host"):
-            game_id = self.redis.hget(session_user_name, "game_id")
-            other_players = self.get_other_players(session_user_name)
-            game_pw = self.redis.hget(session_user_name, "game_pw")
-            self.redis.hdel(session_user_name, "game_pw", "game_host")
-            self.redis.hset(session_user_name, "character", "None")
-            if other_players:
-                new_host = next(iter(other_players.keys()))
-                self.redis.hset(new_host, "game_host", "true")
-                self.redis.hset(new_host, "game_pw", game_pw)
-        games_list = self.get_list_of_games()
+        self.remove_player_from_game(session_user_name)
         response = self.render_template(
             'index.html',
             error=None,
             username=session_user_name
         )
-        self.redis.hset(session_user_name, "game_id", "None")
-        self.redis.hset(session_user_name, "character", "None")
-        self.redis.hset(session_user_name, "solved", "false")
         return response
 
     def logout(self, request, sid):
         response = self.render_template("login.html", success="Abgemeldet.")
         session_user_name = self.get_user(request.session.sid)
-        self.redis.hset(session_user_name, "session_id", "None")
+        pipe = self.transaction()
+        pipe.hdel(self.user_key(session_user_name), "session_id")
+        pipe.delete(self.session_key(request.session.sid))
+        pipe.execute()
+        self.session_store.delete(request.session)
         return response
 
     def start(self, request, sid):
@@ -309,14 +1506,23 @@ class Werbinich(object):
 
     def show_games(self, request, sid):
         username = self.get_user(request.session.sid)
-        games_list = self.get_list_of_games()
-        response = self.render_template(
+        return self.render_lobby(request, error=None, username=username)
+
+    def render_lobby(self, request, **context):
+        """ render one page of the lobby, `cursor` and `game_prefix` come from the form """
+        prefix = request.form.get("game_prefix", "").strip()
+        cursor = request.form.get("cursor") or None
+        if prefix and not validate_username(prefix):
+            prefix = ""
+            cursor = None
+        games, next_cursor = self.get_lobby_page(cursor=cursor, prefix=prefix)
+        return self.render_template(
             'join_game.html',
-            error=None,
-            game_list=games_list,
-            username=username
+            game_list=games,
+            game_prefix=prefix,
+            next_cursor=next_cursor,
+            **context
         )
-        return response
 
     def enter_new_pw(self, request, sid):
         username = self.get_user(request.session.sid)
@@ -335,7 +1541,7 @@ class Werbinich(object):
         pw_hash = self.get_user_pw(username)
         if (
             pw_hash and
-            sha256.verify(old_pw, pw_hash) and
+            self.hashing.verify(old_pw, pw_hash) and
             new_pw == new_pw_confirm and
             validate_pw(new_pw)
         ):
@@ -352,7 +1558,11 @@ class Werbinich(object):
 
     def confirm_delete(self, request, sid):
         username = self.get_user(request.session.sid)
-        self.redis.delete(username)
+        self.remove_player_from_game(username)
+        pipe = self.transaction()
+        pipe.delete(self.user_key(username), self.session_key(request.session.sid))
+        pipe.execute()
+        self.session_store.delete(request.session)
         success = "Daten gelöscht."
         return self.render_template("login.html", success=success)
 
@@ -370,7 +1580,7 @@ class Werbinich(object):
         pw = request.form["pw"].strip()
         new_name = request.form["new_name"].strip()
         pw_hash = self.get_user_pw(username)
-        if sha256.verify(pw, pw_hash) and validate_username(new_name):
+        if self.hashing.verify(pw, pw_hash) and validate_username(new_name):
             self.set_user_name(username, new_name)
             success = "Anzeigename geändert."
             response = self.render_template('index.html', success=success)
@@ -385,8 +1595,8 @@ class Werbinich(object):
         user_id = request.form["user_id"]
         if not user_id:
             error = "Das funktioniert nicht."
-            player_list = self.get_other_players(session_user_name)
-            game_id = self.redis.hget(session_user_name, "game_id")
+            game_id = self.get_game_id(session_user_name)
+            player_list = self.get_other_players(session_user_name, game_id)
             response = self.render_template(
                 'game.html',
                 error=error,
@@ -396,127 +1606,1188 @@ class Werbinich(object):
                 game_id=game_id
             )
             return response
-        if self.redis.hget(user_id, "solved") == "true":
-            self.redis.hset(user_id, "solved", "false")
-        else:
-            self.redis.hset(user_id, "solved", "true")
+        solved, game_id = self.get_player_fields(user_id, "solved", "game_id")
+        if game_id:
+            pipe = self.transaction()
+            self.set_solved(pipe, game_id, user_id, solved is None)
+            self.touch_game(pipe, game_id)
+            pipe.execute()
         return self.reload_game(request, sid)
 
-    def get_list_of_games(self):
-        """ get a `set` of game IDs """
-        keys = self.get_all_keys()
-        games_list = []
-        if keys:
-            for key in keys:
-                game_id = self.redis.hget(key, "game_id") or "None"
-                if not game_id in games_list and game_id != "None":
-                    games_list.append(game_id)
-        return games_list
+    def get_lobby_page(self, cursor=None, prefix="", count=None):
+        """
+        get one page of `(game_id, player_count)` and the cursor of the next page,
+        most recently active games first or, with `prefix`, ordered by game ID
+        """
+        count = count or self.config["lobby_page_size"]
+        client = self.reader()
+        if prefix:
+            # the cursor is the last game ID of the previous page
+            game_ids = client.zrangebylex(
+                LOBBY_IDS_KEY,
+                f"({cursor}" if cursor else f"[{prefix}",
+                f"[{prefix}\xff",
+                start=0,
+                num=count + 1
+            )
+            cursors = game_ids
+        else:
+            # the cursor is activity score and ID of the last game of the previous page,
+            # games with the same score come in descending ID order
+            last_score, _, last_id = (cursor or "").partition(":")
+            try:
+                last_score = float(last_score)
+            except ValueError:
+                last_score = math.nan
+            if not math.isfinite(last_score):
+                last_score, last_id = math.inf, None
+            entries = []
+            offset = 0
+            while len(entries) <= count:
+                batch = client.zrevrangebyscore(
+                    LOBBY_KEY,
+                    last_score,
+                    "-inf",
+                    start=offset,
+                    num=count + 1,
+                    withscores=True
+                )
+                offset += len(batch)
+                entries.extend(
+                    (game_id, score) for game_id, score in batch
+                    if last_id is None or score < last_score or game_id < last_id
+                )
+                if len(batch) <= count:
+                    break
+            game_ids = [game_id for game_id, _ in entries]
+            cursors = [f"{score!r}:{game_id}" for game_id, score in entries]
+        next_cursor = cursors[count - 1] if len(game_ids) > count else None
+        game_ids = game_ids[:count]
+        pipe = client.pipeline(transaction=False)
+        for game_id in game_ids:
+            pipe.scard(self.game_players_key(game_id))
+        return list(zip(game_ids, pipe.execute())), next_cursor
+
+    def game_key(self, game_id):
+        """ key of the hash holding host and pw hash of a game """
+        return f"{GAME_KEY_PREFIX}{game_id}"
+
+    def game_players_key(self, game_id):
+        """ key of the set of players in a game """
+        return f"{GAME_KEY_PREFIX}{game_id}:players"
+
+    def player_key(self, username):
+        """ key of the hash holding game, character and solved flag of a player """
+        return f"{PLAYER_KEY_PREFIX}{username}"
+
+    def add_player_to_game(self, username, game_id, pw_hash):
+        """
+        add a player to a game and out of their old one, creating the game with
+        `pw_hash` if it does not exist; returns the status "created" or "joined",
+        or "exists" and the pw hash of the game if it has another one
+        """
+        result = self.run_game_script(
+            "join_game",
+            [
+                self.user_key(username), self.player_key(username),
+                GAMES_KEY, LOBBY_KEY, LOBBY_IDS_KEY, GAMES_CREATED_KEY
+            ],
+            username, game_id, pw_hash
+        )
+        return result["status"], result.get("pw_hash")
+
+    def remove_player_from_game(self, username):
+        """
+        remove a player and their player hash, hand over host or remove the
+        game if it is empty afterwards
+        """
+        self.run_game_script(
+            "leave_game",
+            [self.player_key(username), GAMES_KEY, LOBBY_KEY, LOBBY_IDS_KEY],
+            username
+        )
+
+    def set_character_if_empty(self, game_id, player, character):
+        """
+        give a player of the game a new character unless their current one is
+        unsolved; returns "set", "taken" or "not_playing"
+        """
+        result = self.run_game_script(
+            "set_character",
+            [self.player_key(player), LOBBY_KEY],
+            player, game_id, character
+        )
+        return result["status"]
 
-    def set_user_pw(self, username, password):
+    def run_game_script(self, name, keys, *args, now=None):
+        """
+        run one of the game scripts in a single EVALSHA, drop the keys it wrote
+        from the local cache and return its result
+        """
+        trace = current_trace()
+        if trace is not None:
+            trace.wrote = True
+        result = json.loads(self.scripts[name](
+            keys=keys,
+            args=[GAME_KEY_PREFIX, CACHE_INVALIDATE_CHANNEL, now or time.time(), *args]
+        ))
+        self.cache.invalidate(result.get("written", ()))
+        return result
+
+    def load_scripts(self):
+        """ SCRIPT LOAD the game scripts once, they are then called by their sha1 """
+        for script in self.scripts.values():
+            script.sha = self.redis.script_load(script.script)
+
+    def game_events_key(self, game_id):
+        """ pub/sub channel for changes of the players in a game """
+        return f"{GAME_KEY_PREFIX}{game_id}:events"
+
+    def set_character(self, pipe, game_id, player, character):
+        """ queue giving `player` a new, unsolved character """
+        pipe.hset(self.player_key(player), "character", character)
+        pipe.hdel(self.player_key(player), "solved")
+        self.publish_game_event(
+            pipe, game_id, "character", player, character=character, solved="false"
+        )
+
+    def set_solved(self, pipe, game_id, player, solved):
+        """ queue setting or clearing the solved flag of `player` """
+        if solved:
+            pipe.hset(self.player_key(player), "solved", 1)
+        else:
+            pipe.hdel(self.player_key(player), "solved")
+        self.publish_game_event(
+            pipe, game_id, "solved", player, solved="true" if solved else "false"
+        )
+
+    def publish_game_event(self, pipe, game_id, event, player, **data):
+        """ queue publishing a change of `player` to the game's event stream """
+        if not game_id:
+            return
+        data.update(event=event, player=player)
+        pipe.publish(self.game_events_key(game_id), json.dumps(data))
+        pipe.hincrby(self.game_key(game_id), "version", 1)
+
+    def touch_game(self, pipe, game_id):
+        """ queue recording activity in a game for the reaper """
+        if not game_id:
+            return
+        now = time.time()
+        pipe.hset(self.game_key(game_id), "last_active", int(now))
+        pipe.zadd(LOBBY_KEY, {game_id: now}, xx=True)
+
+    def reap(self, now=None):
+        """
+        remove abandoned games and idle players, clear stale fields,
+        works through users and games in SCAN batches
+        """
+        now = now or time.time()
+        report = {"games": 0, "players": 0, "fields": 0, "keys": 0}
+        batch_size = self.config["scan_count"]
+        games = self.redis.sscan_iter(GAMES_KEY, count=batch_size)
+        for batch in batched(games, batch_size):
+            self.reap_games(batch, now, report)
+        for batch in batched(self.iter_usernames(), batch_size):
+            self.reap_users(batch, now, report)
+        return report
+
+    def reap_games(self, game_ids, now, report):
+        """
+        remove games without players or without activity for `game_idle_time`,
+        the candidates are checked again by the expire script
+        """
+        reads = self.redis.pipeline(transaction=False)
+        for game_id in game_ids:
+            reads.hget(self.game_key(game_id), "last_active")
+            reads.scard(self.game_players_key(game_id))
+        results = reads.execute()
+        for game_id, last_active, players in zip(game_ids, results[::2], results[1::2]):
+            if (
+                players and last_active is not None and
+                now - int(last_active) <= self.config["game_idle_time"]
+            ):
+                continue
+            result = self.run_game_script(
+                "expire_game",
+                [GAMES_KEY, LOBBY_KEY, LOBBY_IDS_KEY],
+                game_id, self.config["game_idle_time"], PLAYER_KEY_PREFIX,
+                now=now
+            )
+            if result["status"] == "expired":
+                report["games"] += 1
+                report["players"] += result["players"]
+                report["keys"] += 2 + result["players"]
+
+    def reap_users(self, usernames, now, report):
+        """
+        clear session ids of expired sessions, remove player hashes of removed
+        games and players whose session was idle for `player_idle_time`
+        """
+        reads = self.redis.pipeline(transaction=False)
+        for username in usernames:
+            reads.hget(self.user_key(username), "session_id")
+            reads.hget(self.player_key(username), "game_id")
+        results = reads.execute()
+        rows = list(zip(results[::2], results[1::2]))
+        reads = self.redis.pipeline(transaction=False)
+        for session_id, game_id in rows:
+            reads.ttl(self.session_key(session_id))
+            reads.sismember(GAMES_KEY, game_id or "")
+        results = reads.execute()
+        writes = self.transaction()
+        for username, (session_id, game_id), ttl, game_exists in zip(
+            usernames, rows, results[::2], results[1::2]
+        ):
+            if session_id and ttl == -2:
+                writes.hdel(self.user_key(username), "session_id")
+                report["fields"] += 1
+            if not game_id:
+                continue
+            idle = ttl == -2 or (
+                ttl >= 0 and
+                self.config["session_ttl"] - ttl > self.config["player_idle_time"]
+            )
+            if game_exists and not idle:
+                continue
+            if game_exists:
+                self.remove_player_from_game(username)
+                report["players"] += 1
+            else:
+                writes.delete(self.player_key(username))
+            report["keys"] += 1
+        writes.execute()
+
+    def start_reaper(self):
+        """
+        run `reap` every `reaper_interval` seconds in a daemon thread,
+        a lock in Redis makes only one of several workers reap per interval
+        """
+        interval = self.config["reaper_interval"]
+
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    if self.redis.set(REAPER_LOCK_KEY, os.getpid(), nx=True, ex=interval):
+                        logger.info("reaper: %s", self.reap())
+                except redis.RedisError:
+                    logger.exception("reaper failed")
+
+        thread = threading.Thread(target=run, name="werbinich-reaper", daemon=True)
+        thread.start()
+        return thread
+
+    def set_user_pw(self, username, password, pipe=None):
         """ insert new pw hash into db """
-        pw_hash = sha256.hash(password)
-        self.redis.hset(username, "pw_hash", pw_hash)
+        pw_hash = self.hashing.hash(password)
+        (pipe or self.redis).hset(self.user_key(username), "pw_hash", pw_hash)
 
     def set_user_name(self, username, name):
-        self.redis.hset(username, "name", name)
+        """ set the display name, in a game together with a version bump and event """
+        player_key = self.player_key(username)
+        # retried if the user joins or leaves a game in the meantime
+        while True:
+            with self.transaction() as pipe:
+                try:
+                    pipe.watch(player_key)
+                    game_id = pipe.hget(player_key, "game_id")
+                    pipe.multi()
+                    pipe.hset(self.user_key(username), "name", name)
+                    self.publish_game_event(pipe, game_id, "name", username, name=name)
+                    pipe.execute()
+                    return
+                except redis.WatchError:
+                    continue
 
-    def set_user_name_and_pw(self, username, name, password):
+    def set_user_name_and_pw(self, username, name, password, pipe=None):
         """ insert name, pw into db """
-        pw_hash = sha256.hash(password)
-        self.redis.hset(username, "pw_hash", pw_hash)
-        self.redis.hset(username, "name", name)
+        pw_hash = self.hashing.hash(password)
+        (pipe or self.redis).hset(
+            self.user_key(username),
+            mapping={"pw_hash": pw_hash, "name": name}
+        )
 
     def get_user_pw(self, username):
         """ get hash of user pw """
-        keys = self.get_all_keys()
-        if username in keys:
-            res = self.redis.hget(username, "pw_hash")
-        else:
-            res = None
+        res, = self.get_fields(username, "pw_hash")
         return res
 
     def check_cookie_data(self, request):
         """ check whether cookie was tampered with """
-        keys = self.get_all_keys()
         cookie_user_name = request.cookies.get("username")
-        if cookie_user_name in keys:
-            cookie_sid = request.cookies.get("session_id")
-            cookie_game_id = request.cookies.get("game_id")
-            saved_session_id = self.redis.hget(cookie_user_name, "session_id")
-            if self.redis.hexists(cookie_user_name, "game_id"):
-                saved_game_id = self.redis.hget(cookie_user_name, "game_id")
-            else:
-                saved_game_id = "None"
-            return saved_session_id == cookie_sid and (saved_game_id == str(cookie_game_id) or saved_game_id == "None")
-        else:
+        if cookie_user_name is None:
             return False
+        saved_session_id, = self.get_fields(cookie_user_name, "session_id")
+        if saved_session_id is None:
+            return False
+        saved_game_id = self.get_game_id(cookie_user_name)
+        cookie_sid = request.cookies.get("session_id")
+        cookie_game_id = request.cookies.get("game_id")
+        return saved_session_id == cookie_sid and saved_game_id in (None, cookie_game_id)
+
+    def user_key(self, username):
+        """ key of the hash holding the data of a user """
+        return f"{USER_KEY_PREFIX}{username}"
+
+    def get_fields(self, username, *fields):
+        """ get several fields of a user hash in one round trip """
+        return self.redis.hmget(self.user_key(username), *fields)
+
+    def get_player_fields(self, username, *fields):
+        """ get several fields of a player hash in one round trip """
+        return self.redis.hmget(self.player_key(username), *fields)
+
+    def get_game_id(self, username):
+        """ get the game a user plays in, `None` if they do not play """
+        return self.redis.hget(self.player_key(username), "game_id")
+
+    def get_fields_of_users(self, usernames, *fields, client=None):
+        """ get the same fields of several user hashes in one pipelined batch """
+        pipe = (client or self.redis).pipeline(transaction=False)
+        for username in usernames:
+            pipe.hmget(self.user_key(username), *fields)
+        return pipe.execute()
 
-    def get_other_players(self, user_id):
+    def transaction(self):
+        """ collect writes to send them as one MULTI/EXEC transaction """
+        trace = current_trace()
+        if trace is not None:
+            trace.wrote = True
+        return self.redis.pipeline(transaction=True)
+
+    def reader(self):
+        """
+        client for reads that may lag behind: the replica if there is one,
+        the primary once the current request wrote so it reads its own writes
+        """
+        trace = current_trace()
+        if trace is not None and trace.wrote:
+            return self.redis
+        return self.replica_redis
+
+    def get_other_players(self, user_id, user_game_id=None):
         """ get other players in the same game """
-        keys = self.get_all_keys()
         player_list = {}
-        user_game_id = self.redis.hget(user_id, "game_id")
-        for key in keys:
-            if self.redis.hget(key, "game_id") == str(user_game_id) and str(user_id) != key:
-                name, character, solved = self.redis.hmget(key, "name", "character", "solved")
-                player_list[key] = {
-                    "name": name,
-                    "character": character if str(character) != "None" else "-",
-                    "solved": solved
-                }
+        if user_game_id is None:
+            user_game_id = self.get_profiles([user_id])[0]["game_id"]
+        if not user_game_id:
+            return player_list
+        players = sorted(self.get_game_players(user_game_id) - {str(user_id)})
+        for key, profile in zip(players, self.get_profiles(players)):
+            player_list[key] = {
+                "name": profile["name"],
+                "character": profile["character"] or "-",
+                "solved": "true" if profile["solved"] else "false"
+            }
         return player_list
 
+    def get_game_roster(self, game_id):
+        """
+        get host, version, creation number and `{username: player}` of all
+        players in a game
+        """
+        host, version, created = self.get_game_info(game_id)
+        players = sorted(self.get_game_players(game_id))
+        roster = {}
+        for username, profile in zip(players, self.get_profiles(players)):
+            roster[username] = {"name": profile["name"], "solved": profile["solved"]}
+            if profile["character"]:
+                roster[username]["character"] = profile["character"]
+        return host, version, created, roster
+
+    def start_cache_listener(self):
+        """
+        apply the invalidations published by all processes to the local cache
+        in a daemon thread, the cache is only used while subscribed
+        """
+        def run():
+            while True:
+                pubsub = self.events_redis.pubsub()
+                try:
+                    pubsub.subscribe(CACHE_INVALIDATE_CHANNEL)
+                    while True:
+                        message = pubsub.get_message(timeout=1.0)
+                        if message is None:
+                            continue
+                        if message["type"] == "subscribe":
+                            self.cache.clear()
+                            self.cache.enabled = True
+                        elif message["type"] == "message":
+                            self.cache.invalidate(json.loads(message["data"]))
+                except redis.RedisError:
+                    logger.exception("cache invalidation listener failed")
+                finally:
+                    self.cache.enabled = False
+                    self.cache.clear()
+                    pubsub.close()
+                time.sleep(1)
+
+        thread = threading.Thread(target=run, name="werbinich-cache", daemon=True)
+        thread.start()
+        return thread
+
+    def cache_client(self):
+        """
+        client for reads that fill the local cache: the primary, a lagging
+        replica could put values back that were just invalidated
+        """
+        return self.redis if self.cache.enabled else self.reader()
+
+    def get_profiles(self, usernames):
+        """
+        get name, game_id, character and solved of several users as dicts,
+        the user names and player hashes are read through the local cache
+        """
+        def load(keys):
+            pipe = self.cache_client().pipeline(transaction=False)
+            for key in keys:
+                if key.startswith(USER_KEY_PREFIX):
+                    pipe.hget(key, "name")
+                else:
+                    pipe.hgetall(key)
+            return pipe.execute()
+
+        keys = [self.user_key(username) for username in usernames]
+        keys += [self.player_key(username) for username in usernames]
+        values = self.cache.fetch_many(keys, load)
+        return [
+            {
+                "name": name,
+                "game_id": player.get("game_id"),
+                "character": player.get("character"),
+                "solved": "solved" in player,
+            }
+            for name, player in zip(values[:len(usernames)], values[len(usernames):])
+        ]
+
+    def get_game_players(self, game_id):
+        """ get the usernames of the players in a game through the local cache """
+        key = self.game_players_key(game_id)
+        return self.cache.fetch(key, lambda: frozenset(self.cache_client().smembers(key)))
+
+    def get_game_info(self, game_id):
+        """ get host, version and creation number of a game through the local cache """
+        key = self.game_key(game_id)
+        host, version, created = self.cache.fetch(
+            key, lambda: tuple(self.cache_client().hmget(key, "host", "version", "created"))
+        )
+        return host, int(version or 0), int(created or 0)
+
     def get_game_pw(self, game_id):
-        """ get game pw from host """
-        keys = self.get_all_keys()
-        res = "None"
-        for key in keys:
-            if self.redis.hexists(key, "game_host") and self.redis.hget(key, "game_id") == game_id:
-                res = str(self.redis.hget(key, "game_pw"))
-        return res
+        """ get pw hash of a game, `None` if there is no such game """
+        return self.redis.hget(self.game_key(game_id), "pw_hash")
+
+    def session_key(self, session_id):
+        """ key of the session index entry for `session_id` """
+        return f"{SESSION_KEY_PREFIX}{session_id}"
 
     def get_user(self, session_id):
-        keys = self.get_all_keys()
-        for key in keys:
-            if self.redis.hexists(key, "session_id"):
-                key_session_id = self.redis.hget(key, "session_id")
-                if key_session_id == session_id:
-                    return key
-        return "None"
+        """ look up the user of a session in the session index """
+        if session_id is None:
+            return "None"
+        key = self.session_key(session_id)
+
+        def load():
+            # sliding expiry, refreshed whenever the local cache misses
+            pipe = self.redis.pipeline()
+            pipe.get(key)
+            pipe.expire(key, self.config["session_ttl"])
+            username, _ = pipe.execute()
+            return username
+
+        return self.cache.fetch(key, load) or "None"
+
+    def save_session(self, request, response):
+        """ save the session if needed and set the session cookie """
+        self.session_store.save_if_modified(request.session)
+        response.set_cookie(
+            "session_id",
+            self.session_store.cookie_value(request.session),
+            httponly=True
+        )
 
     def session_exists(self, session_id):
-        keys = self.get_all_keys()
+        username = self.get_user(session_id)
+        if username == "None":
+            return False
+        return username
+
+    def set_user_session(self, user, session_id, old_session_id=MISSING, pipe=None):
+        """
+        store the session id and keep the session index up to date,
+        queue the writes on `pipe` if given
+        """
+        if old_session_id is MISSING:
+            old_session_id, = self.get_fields(user, "session_id")
+        writes = pipe or self.transaction()
+        if old_session_id and old_session_id != session_id:
+            writes.delete(self.session_key(old_session_id))
+        writes.hset(self.user_key(user), "session_id", session_id)
+        writes.set(
+            self.session_key(session_id), user, ex=self.config["session_ttl"]
+        )
+        if pipe is None:
+            writes.execute()
+
+    def check_schema(self):
+        """ mark an empty db with the current schema version, warn if the data is older """
+        if self.redis.set(SCHEMA_VERSION_KEY, SCHEMA_VERSION, nx=True) and self.redis.dbsize() > 1:
+            # data from before schema versions
+            self.redis.set(SCHEMA_VERSION_KEY, 1)
+        version = int(self.redis.get(SCHEMA_VERSION_KEY))
+        if version < SCHEMA_VERSION:
+            logger.warning(
+                "data has schema version %d, run `python werbinich.py migrate` to upgrade to %d",
+                version, SCHEMA_VERSION
+            )
+        return version
+
+    def migrate(self, dry_run=False):
+        """
+        convert the data to schema `SCHEMA_VERSION` in SCAN batches of users,
+        while the app keeps running, report what changed and memory before and after
+        """
+        moved, conflicts = self.namespace_user_keys(dry_run)
+        report = {
+            "moved": len(moved),
+            "conflicts": conflicts,
+            "users": 0,
+            "players": 0,
+            "fields": 0,
+            "sessions": 0,
+            "bytes_before": 0,
+            "bytes_after": None if dry_run else 0,
+            "used_memory_before": self.used_memory(),
+            "used_memory_after": None,
+        }
+        if dry_run:
+            # not renamed in a dry run, read them under the bare username
+            for batch in batched(moved, self.config["scan_count"]):
+                self.migrate_users(batch, dry_run, report, user_keys=batch)
+        for batch in batched(self.iter_usernames(), self.config["scan_count"]):
+            self.migrate_users(batch, dry_run, report)
+        if not dry_run:
+            self.redis.set(SCHEMA_VERSION_KEY, SCHEMA_VERSION)
+            report["used_memory_after"] = self.used_memory()
+        return report
+
+    def migrate_users(self, usernames, dry_run, report, user_keys=None):
+        """
+        move the game fields of a batch of user hashes to player hashes,
+        drop `"None"` sentinels, legacy host fields and ids of expired sessions,
+        retried if one of the users changes meanwhile; `user_keys` are read
+        instead of `user:<name>`
+        """
+        user_keys = user_keys or [self.user_key(username) for username in usernames]
+        player_keys = [self.player_key(username) for username in usernames]
+        legacy_fields = ("game_id", "character", "solved", "game_host", "game_pw")
+        while True:
+            pipe = self.redis.pipeline()
+            try:
+                pipe.watch(*user_keys, *player_keys)
+                reads = self.redis.pipeline(transaction=False)
+                for user_key, player_key in zip(user_keys, player_keys):
+                    reads.hgetall(user_key)
+                    reads.exists(player_key)
+                results = reads.execute()
+                users = results[::2]
+                reads = self.redis.pipeline(transaction=False)
+                for user in users:
+                    reads.exists(self.session_key(user.get("session_id")))
+                sessions_exist = reads.execute()
+                bytes_before = self.memory_usage(user_keys + player_keys)
+                counts = {"users": 0, "players": 0, "fields": 0, "sessions": 0}
+                pipe.multi()
+                for username, user_key, user, player_exists, session_exists in zip(
+                    usernames, user_keys, users, results[1::2], sessions_exist
+                ):
+                    fields = [field for field in legacy_fields if field in user]
+                    if "session_id" in user and not session_exists:
+                        fields.append("session_id")
+                        counts["sessions"] += 1
+                    if not fields:
+                        continue
+                    pipe.hdel(user_key, *fields)
+                    counts["users"] += 1
+                    counts["fields"] += len(fields)
+                    game_id = user.get("game_id")
+                    if game_id in (None, "None") or player_exists:
+                        continue
+                    player = {"game_id": game_id}
+                    if user.get("character") not in (None, "None"):
+                        player["character"] = user["character"]
+                    if user.get("solved") == "true":
+                        player["solved"] = 1
+                    pipe.hset(self.player_key(username), mapping=player)
+                    pipe.sadd(GAMES_KEY, game_id)
+                    pipe.sadd(self.game_players_key(game_id), username)
+                    pipe.zadd(LOBBY_KEY, {game_id: time.time()}, nx=True)
+                    pipe.zadd(LOBBY_IDS_KEY, {game_id: 0}, nx=True)
+                    if user.get("game_host") == "true" and user.get("game_pw"):
+                        pipe.hsetnx(self.game_key(game_id), "host", username)
+                        pipe.hsetnx(self.game_key(game_id), "pw_hash", user["game_pw"])
+                    counts["players"] += 1
+                if not dry_run:
+                    pipe.execute()
+            except redis.WatchError:
+                continue
+            finally:
+                pipe.reset()
+            break
+        for name, count in counts.items():
+            report[name] += count
+        bytes_after = None if dry_run else self.memory_usage(user_keys + player_keys)
+        for name, size in (("bytes_before", bytes_before), ("bytes_after", bytes_after)):
+            if report[name] is not None:
+                report[name] = None if size is None else report[name] + size
+
+    def memory_usage(self, keys):
+        """ bytes used by `keys`, `None` if the server does not report it """
+        pipe = self.redis.pipeline(transaction=False)
         for key in keys:
-            if self.redis.hexists(key, "session_id"):
-                key_session_id = self.redis.hget(key, "session_id")
-                if key_session_id == session_id:
-                    return key
-        return False
-
-    def set_user_session(self, user, session_id):
-        self.redis.hset(user, "session_id", session_id)
-
-    def get_all_keys(self):
-        i = 0
-        res = self.redis.scan(i)
-        keys = res[1]
-        while res[0] != 0:
-            res = self.redis.scan(i)
-            keys += res[1]
-            i += 1
-        return set(keys)
-
-
-def create_app(with_static=True):
-    app = Werbinich()
+            pipe.memory_usage(key)
+        try:
+            return sum(size or 0 for size in pipe.execute())
+        except redis.ResponseError:
+            return None
+
+    def used_memory(self):
+        """ memory used by the Redis server, `None` if it does not report it """
+        try:
+            return self.redis.info("memory")["used_memory"]
+        except redis.ResponseError:
+            return None
+
+    def namespace_user_keys(self, dry_run=False):
+        """
+        move user hashes stored under the bare username to `user:<name>`,
+        return the moved usernames and how many were left where they are
+        because `user:<name>` exists already
+        """
+        moved = []
+        conflicts = 0
+        for key in self.scan_iter("*"):
+            if not self.is_legacy_user_key(key) or self.redis.type(key) != "hash":
+                continue
+            if dry_run:
+                free = not self.redis.exists(self.user_key(key))
+            else:
+                free = self.redis.renamenx(key, self.user_key(key))
+            if free:
+                moved.append(key)
+            else:
+                conflicts += 1
+                logger.warning(
+                    "user hash %r not moved, %r exists already", key, self.user_key(key)
+                )
+        return moved, conflicts
+
+    def is_legacy_user_key(self, key):
+        """ tell user hashes without prefix apart from the other keys """
+        return not (
+            key == GAMES_KEY or
+            key == SCHEMA_VERSION_KEY or
+            key.startswith(USER_KEY_PREFIX) or
+            key.startswith(PLAYER_KEY_PREFIX) or
+            key.startswith(SESSION_KEY_PREFIX) or
+            key.startswith(GAME_KEY_PREFIX) or
+            key.startswith(LOBBY_KEY_PREFIX) or
+            key.startswith(RATE_LIMIT_KEY_PREFIX)
+        )
+
+    def scan_iter(self, match, count=None):
+        """
+        lazily iterate over the keys matching `match`,
+        `count` is the SCAN batch size hint
+        """
+        return self.redis.scan_iter(
+            match=match,
+            count=count or self.config["scan_count"]
+        )
+
+    def iter_usernames(self, count=None):
+        """ lazily iterate over all usernames """
+        prefix_len = len(USER_KEY_PREFIX)
+        for key in self.scan_iter(f"{USER_KEY_PREFIX}*", count):
+            yield key[prefix_len:]
+
+
+def batched(iterable, size):
+    """ split an iterable into lists of up to `size` items """
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def create_connection_pool(config, max_connections=None, client_module=redis,
+                           decode_responses=True, replica=False):
+    """
+    create a bounded Redis connection pool from `config`,
+    pass `redis.asyncio` as `client_module` for an asyncio pool,
+    with `replica` a pool for reads that may lag or `None` if no replica is set up
+    """
+    kwargs = {
+        "decode_responses": decode_responses,
+        "max_connections": max_connections or config["redis_max_connections"],
+        "socket_timeout": config["redis_socket_timeout"],
+        "socket_connect_timeout": config["redis_socket_connect_timeout"],
+    }
+    if config["redis_sentinels"]:
+        sentinels = [tuple(address.rsplit(":", 1)) for address in config["redis_sentinels"]]
+        manager = client_module.sentinel.Sentinel(
+            [(host, int(port)) for host, port in sentinels],
+            socket_timeout=config["redis_socket_timeout"]
+        )
+        return client_module.sentinel.SentinelConnectionPool(
+            config["redis_sentinel_service"], manager,
+            is_master=not replica, db=config["redis_db"], **kwargs
+        )
+    kwargs["timeout"] = config["redis_pool_timeout"]
+    if replica:
+        urls = config["redis_replica_urls"]
+        if not urls:
+            return None
+        # spread the worker processes over the replicas
+        return client_module.BlockingConnectionPool.from_url(
+            urls[os.getpid() % len(urls)], **kwargs
+        )
+    if config["redis_url"]:
+        return client_module.BlockingConnectionPool.from_url(config["redis_url"], **kwargs)
+    kwargs["db"] = config["redis_db"]
+    if config["redis_unix_socket"]:
+        del kwargs["socket_connect_timeout"]
+        kwargs["connection_class"] = client_module.UnixDomainSocketConnection
+        kwargs["path"] = config["redis_unix_socket"]
+    else:
+        kwargs["host"] = config["redis_host"]
+        kwargs["port"] = config["redis_port"]
+    return client_module.BlockingConnectionPool(**kwargs)
+
+
+def load_config(path=None, environ=os.environ):
+    """
+    read config from the JSON file at `path` or `$WERBINICH_CONFIG`,
+    then from `WERBINICH_<KEY>` environment variables, which hold
+    plain strings for string keys and JSON for all others
+    """
+    config = {}
+    path = path or environ.get("WERBINICH_CONFIG")
+    if path:
+        with open(path) as f:
+            config.update(json.load(f))
+    for key, default in DEFAULT_CONFIG.items():
+        value = environ.get(f"WERBINICH_{key.upper()}")
+        if value is None:
+            continue
+        if not (isinstance(default, str) or key in STRING_CONFIG_KEYS):
+            try:
+                value = json.loads(value)
+            except ValueError:
+                raise ValueError(f"WERBINICH_{key.upper()} is not valid JSON")
+        config[key] = value
+    return config
+
+
+class StaticAsset(object):
+    """ a static file with its fingerprint and precompressed variants """
+
+    def __init__(self, filename, data):
+        self.filename = filename
+        self.digest = hashlib.sha256(data).hexdigest()[:12]
+        root, ext = os.path.splitext(filename)
+        self.fingerprinted = f"{root}.{self.digest}{ext}"
+        self.mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        self.variants = {"identity": data}
+        compressed = {"gzip": gzip.compress(data, 9, mtime=0)}
+        if brotli is not None:
+            compressed["br"] = brotli.compress(data)
+        for encoding, body in compressed.items():
+            if len(body) < len(data) * 0.9:
+                self.variants[encoding] = body
+
+
+class StaticAssets(object):
+    """
+    serve the files of `directory` under `prefix` with content hashes in their
+    URLs, cached forever by browsers, and gzip or brotli precompressed at startup
+    """
+
+    max_age = 60 * 60 * 24 * 365
+
+    def __init__(self, app, directory, prefix="/static"):
+        self.app = app
+        self.prefix = prefix
+        self.assets = {}
+        self.urls = {}
+        for root, _, filenames in os.walk(directory):
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                name = os.path.relpath(path, directory).replace(os.sep, "/")
+                with open(path, "rb") as f:
+                    asset = StaticAsset(name, f.read())
+                self.assets[name] = self.assets[asset.fingerprinted] = asset
+                self.urls[name] = f"{prefix}/{asset.fingerprinted}"
+
+    def url(self, filename):
+        """ fingerprinted URL of a static file, used as `static_url` in templates """
+        return self.urls.get(filename, f"{self.prefix}/{filename}")
+
+    def __call__(self, environ, start_response):
+        path = environ.get("PATH_INFO", "")
+        asset = None
+        if path.startswith(self.prefix + "/"):
+            asset = self.assets.get(path[len(self.prefix) + 1:])
+        if asset is None:
+            return self.app(environ, start_response)
+        request = Request(environ)
+        encoding = "identity"
+        for candidate in ("br", "gzip"):
+            if candidate in asset.variants and request.accept_encodings[candidate]:
+                encoding = candidate
+                break
+        response = Response(asset.variants[encoding], mimetype=asset.mimetype)
+        if path.endswith(asset.fingerprinted):
+            response.headers["Cache-Control"] = f"public, max-age={self.max_age}, immutable"
+        else:
+            # old links without fingerprint are revalidated
+            response.headers["Cache-Control"] = "no-cache"
+        if encoding != "identity":
+            response.headers["Content-Encoding"] = encoding
+        response.headers["Vary"] = "Accept-Encoding"
+        response.set_etag(f"{asset.digest}-{encoding}")
+        return response.make_conditional(request)(environ, start_response)
+
+
+def create_app(with_static=True, config=None):
+    app = Werbinich(config)
     if with_static:
-        app.wsgi_app = SharedDataMiddleware(app.wsgi_app, {
-            '/static':  os.path.join(os.path.dirname(__file__), 'static')
+        app.wsgi_app = StaticAssets(
+            app.wsgi_app, os.path.join(os.path.dirname(__file__), 'static')
+        )
+        app.jinja_env.globals["static_url"] = app.wsgi_app.url
+    if app.config["proxy_hops"]:
+        # client IPs for rate limits from X-Forwarded-For behind a load balancer
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config["proxy_hops"])
+    # before anything else writes to an empty db, e.g. the template bytecode cache
+    app.check_schema()
+    if app.config["precompile_templates"]:
+        app.precompile_templates()
+    app.load_scripts()
+    if app.config["reaper_interval"]:
+        app.start_reaper()
+    if app.config["cache_size"]:
+        app.start_cache_listener()
+    return app
+
+
+class GameEventHub(object):
+    """
+    share one pattern subscription to all game event channels
+    between the event streams of an ASGI process
+    """
+
+    def __init__(self, redis_client, heartbeat):
+        self.redis = redis_client
+        self.heartbeat = heartbeat
+        self.queues = {}
+        self.task = None
+
+    def subscribe(self, channel):
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.run())
+        queue = asyncio.Queue(maxsize=100)
+        self.queues.setdefault(channel, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, channel, queue):
+        queues = self.queues.get(channel, set())
+        queues.discard(queue)
+        if not queues:
+            self.queues.pop(channel, None)
+
+    async def run(self):
+        """ forward published events to the queues of the streams """
+        while True:
+            pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.psubscribe(f"{GAME_KEY_PREFIX}*:events")
+                while True:
+                    message = await pubsub.get_message(timeout=self.heartbeat)
+                    if message is None:
+                        continue
+                    for queue in self.queues.get(message["channel"], ()):
+                        if not queue.full():
+                            queue.put_nowait(message["data"])
+            except redis.RedisError:
+                logger.exception("game event subscription failed")
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.reset()
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+
+
+def serve(config):
+    """
+    run `workers` processes of the ASGI app with gunicorn and uvicorn workers,
+    each one creates its own app, connection pools and threads after forking;
+    event streams wait on asyncio instead of holding one of the threads
+    """
+    from gunicorn.app.base import BaseApplication
+
+    settings = dict(DEFAULT_CONFIG, **config)
+
+    class Server(BaseApplication):
+
+        def load_config(self):
+            self.cfg.set("bind", settings["bind"])
+            self.cfg.set("workers", settings["workers"])
+            self.cfg.set("worker_class", "uvicorn.workers.UvicornWorker")
+            self.cfg.set("preload_app", False)
+
+        def load(self):
+            return create_asgi_app(config=config)
+
+    Server().run()
+
+
+class WerbinichASGI(object):
+    """
+    ASGI entry point: event streams are served on asyncio,
+    form operations run in the WSGI app on a pool of threads
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.config = app.config
+        self.redis = redis.asyncio.StrictRedis(
+            connection_pool=create_connection_pool(
+                self.config, client_module=redis.asyncio
+            )
+        )
+        self.hub = GameEventHub(self.redis, self.config["events_heartbeat"])
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.config["asgi_threads"]
+        )
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+        elif scope["type"] == "http" and scope["path"] == "/events":
+            await self.on_events(scope, receive, send)
+        elif scope["type"] == "http":
+            await self.call_wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.hub.close()
+                self.executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def call_wsgi(self, scope, receive, send):
+        """ run a request through the WSGI app in the thread pool """
+        body = b""
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get("body", b"")
+            more_body = message.get("more_body", False)
+        environ = asgi_to_environ(scope, body)
+        loop = asyncio.get_running_loop()
+        status, headers, body = await loop.run_in_executor(
+            self.executor, run_wsgi, self.app, environ
+        )
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": headers
+        })
+        await send({"type": "http.response.body", "body": body})
+
+    async def get_session_game(self, scope):
+        """ get the session user and their game, `(None, None)` if not in a game """
+        cookie = b"; ".join(value for name, value in scope["headers"] if name == b"cookie")
+        cookies = parse_cookie(cookie.decode("latin-1"))
+        sid = self.app.session_store.sid_from_cookie(cookies.get("session_id"))
+        if sid is None:
+            return None, None
+        username = await self.redis.get(self.app.session_key(sid))
+        if username is None:
+            return None, None
+        return username, await self.redis.hget(self.app.player_key(username), "game_id")
+
+    async def on_events(self, scope, receive, send):
+        """ async version of `Werbinich.on_events` """
+        username, game_id = await self.get_session_game(scope)
+        if game_id is None:
+            await send({"type": "http.response.start", "status": 204, "headers": []})
+            await send({"type": "http.response.body", "body": b""})
+            return
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"text/event-stream; charset=utf-8"),
+                (b"cache-control", b"no-cache"),
+                (b"x-accel-buffering", b"no"),
+            ]
         })
-        return app
+        channel = self.app.game_events_key(game_id)
+        queue = self.hub.subscribe(channel)
+        disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+        try:
+            while not disconnected.done():
+                get = asyncio.ensure_future(queue.get())
+                await asyncio.wait(
+                    {get, disconnected},
+                    timeout=self.config["events_heartbeat"],
+                    return_when=asyncio.FIRST_COMPLETED
+                )
+                if get.done():
+                    if not self.app.event_visible_to(get.result(), username):
+                        continue
+                    chunk = f"data: {get.result()}\n\n"
+                else:
+                    get.cancel()
+                    if disconnected.done():
+                        break
+                    chunk = ": ping\n\n"
+                await send({
+                    "type": "http.response.body",
+                    "body": chunk.encode(),
+                    "more_body": True
+                })
+        finally:
+            self.hub.unsubscribe(channel, queue)
+            disconnected.cancel()
+
+
+async def wait_for_disconnect(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+def asgi_to_environ(scope, body):
+    """ build a WSGI environ from an ASGI http scope """
+    server_name, server_port = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode().decode("latin-1"),
+        "PATH_INFO": scope["path"].encode().decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server_name,
+        "SERVER_PORT": str(server_port),
+        "SERVER_PROTOCOL": f"HTTP/{scope['http_version']}",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    if scope.get("client"):
+        environ["REMOTE_ADDR"] = scope["client"][0]
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1")
+        value = value.decode("latin-1")
+        if name == "content-type":
+            environ["CONTENT_TYPE"] = value
+        elif name == "content-length":
+            environ["CONTENT_LENGTH"] = value
+        else:
+            key = "HTTP_" + name.upper().replace("-", "_")
+            # HTTP/2 may split cookies into several headers
+            separator = "; " if name == "cookie" else ","
+            environ[key] = f"{environ[key]}{separator}{value}" if key in environ else value
+    return environ
+
+
+def run_wsgi(app, environ):
+    """ call a WSGI app, return status, ASGI headers and the body """
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response["status"] = int(status.split(" ", 1)[0])
+        response["headers"] = [
+            (name.lower().encode("latin-1"), value.encode("latin-1"))
+            for name, value in headers
+        ]
+
+    result = app(environ, start_response)
+    try:
+        body = b"".join(result)
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+    return response["status"], response["headers"], body
+
+
+def create_asgi_app(with_static=True, config=None):
+    """ ASGI app, e.g. `uvicorn --factory werbinich:create_asgi_app` """
+    return WerbinichASGI(create_app(with_static, config))
 
 if __name__ == '__main__':
-    from werkzeug.serving import run_simple
-    app = create_app()
-    run_simple('127.0.0.1', 5000, app, use_debugger=True, use_reloader=True)
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "command",
+        nargs="?",
+        default="run",
+        choices=["run", "serve", "migrate", "reap"],
+        help="`run` the dev server (default), `serve` with gunicorn in production, "
+             "`migrate` the data after upgrading "
+             "or `reap` abandoned games, idle players and stale fields"
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="with `migrate`, only report what would change"
+    )
+    parser.add_argument(
+        "--config",
+        help="JSON config file, defaults to $WERBINICH_CONFIG; "
+             "WERBINICH_<KEY> environment variables override single keys"
+    )
+    args = parser.parse_args()
+    config = load_config(args.config)
+    if args.command == "migrate":
+        report = Werbinich(config).migrate(dry_run=args.dry_run)
+        print(
+            f"{'would migrate' if args.dry_run else 'migrated'} to schema version "
+            f"{SCHEMA_VERSION}: {report['moved']} users moved to {USER_KEY_PREFIX}<username> "
+            f"({report['conflicts']} left in place, {USER_KEY_PREFIX}<username> exists), "
+            f"{report['users']} users converted, {report['players']} player hashes created, "
+            f"{report['fields']} fields and {report['sessions']} stale sessions removed."
+        )
+        print(
+            f"memory of converted keys: {report['bytes_before']} bytes before, "
+            f"{report['bytes_after']} bytes after; "
+            f"used_memory: {report['used_memory_before']} before, "
+            f"{report['used_memory_after']} after."
+        )
+    elif args.command == "reap":
+        report = Werbinich(config).reap()
+        print(
+            f"{report['games']} games and {report['players']} players removed, "
+            f"{report['keys']} keys deleted, {report['fields']} fields cleared."
+        )
+    elif args.command == "serve":
+        serve(config)
+    else:
+        from werkzeug.serving import run_simple
+        app = create_app(config=config)
+        run_simple(
+            '127.0.0.1', 5000, app,
+            use_debugger=True, use_reloader=True, threaded=True
+        )